@@ -4,6 +4,7 @@ import requests
 from PIL import Image
 import io
 import base64
+import time
 
 st.set_page_config(page_title="EuroSAT Классификация", page_icon="🛰️", layout="wide")
 
@@ -170,6 +171,8 @@ if uploaded_file:
                     st.info("💡 Нажмите 'Обновить превью'")
     
     # Классификация
+    overlap = st.checkbox("Сглаженная карта (перекрытие окон 50%, примерно в 4 раза дольше)")
+    
     if st.button("🚀 Классифицировать", type="primary", use_container_width=True):
         progress = st.progress(0)
         status = st.empty()
@@ -177,27 +180,40 @@ if uploaded_file:
         with st.spinner("Классификация..."):
             try:
                 status.text("Отправка данных...")
-                progress.progress(25)
                 
                 files = {"file": (uploaded_file.name, file_bytes)}
                 params = {"channels": channels} if channels else {}
+                if overlap:
+                    params["stride"] = 32
+                
+                resp = requests.post(f"{BACKEND_URL}/jobs/", files=files, params=params, timeout=60)
+                if resp.status_code != 202:
+                    raise RuntimeError(f"Ошибка: {resp.status_code}")
+                job = resp.json()
+                
+                # Опрос состояния задачи
+                while job["status"] not in ("done", "error"):
+                    time.sleep(1)
+                    job = requests.get(f"{BACKEND_URL}/jobs/{job['job_id']}", timeout=30).json()
+                    if job["total"]:
+                        progress.progress(min(int(job["progress"] * 100), 100))
+                        status.text(f"Обработано патчей: {job['done']} из {job['total']}")
                 
-                resp = requests.post(f"{BACKEND_URL}/classify_all/", files=files, params=params, timeout=300)
+                if job["status"] == "error":
+                    raise RuntimeError(job["error"])
                 
-                progress.progress(75)
-                status.text("Обработка...")
+                # Загрузка результатов
+                status.text("Загрузка результатов...")
+                results = {}
+                for artifact in ("visualization", "geotiff", "geojson"):
+                    resp = requests.get(f"{BACKEND_URL}/jobs/{job['job_id']}/{artifact}", timeout=120)
+                    resp.raise_for_status()
+                    results[artifact] = resp.content
+                st.session_state.results = results
+                st.session_state.result_image = Image.open(io.BytesIO(results['visualization']))
                 
-                if resp.status_code == 200:
-                    data = resp.json()
-                    st.session_state.results = data
-                    
-                    viz_bytes = base64.b64decode(data['visualization'])
-                    st.session_state.result_image = Image.open(io.BytesIO(viz_bytes))
-                    
-                    progress.progress(100)
-                    st.success("✅ Готово!")
-                else:
-                    st.error(f"Ошибка: {resp.status_code}")
+                progress.progress(100)
+                st.success("✅ Готово!")
             except Exception as e:
                 st.error(f"❌ {str(e)}")
             finally:
@@ -219,11 +235,11 @@ if uploaded_file:
         cols = st.columns(3)
         
         with cols[0]:
-            viz = base64.b64decode(st.session_state.results['visualization'])
+            viz = st.session_state.results['visualization']
             st.download_button("🖼️ PNG", viz, f"{uploaded_file.name.split('.')[0]}_class.png", "image/png")
         
         with cols[1]:
-            tif = base64.b64decode(st.session_state.results['geotiff'])
+            tif = st.session_state.results['geotiff']
             st.download_button("🗺️ GeoTIFF", tif, f"{uploaded_file.name.split('.')[0]}_class.tif", "image/tiff")
         
         with cols[2]:
@@ -0,0 +1,270 @@
+# backends.py
+import argparse
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+
+# Варианты квантизации для облегчённых бэкендов. int8 без калибровки не проходит
+# проверку совпадения с Keras (check_parity), поэтому не поддерживается
+QUANTIZATIONS = ("float16",)
+
+
+class InferenceBackend:
+    """Интерфейс бэкенда инференса: батч патчей -> вероятности классов"""
+    
+    name = "base"
+    
+    def __init__(self, model_path: str, patch_size: int = 64, quantization: Optional[str] = None):
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(f"Неизвестная квантизация: {quantization}")
+        self.model_path = model_path
+        self.patch_size = patch_size
+        self.quantization = quantization
+        self._weights_hash: Optional[str] = None
+    
+    def import_runtime(self):
+        """Импорт библиотеки рантайма (отдельно, чтобы измерять время старта)"""
+    
+    def load(self):
+        """Загрузка модели"""
+        raise NotImplementedError
+    
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """Вероятности классов для батча (N, patch, patch, 3) float32"""
+        raise NotImplementedError
+    
+    @property
+    def weights_hash(self) -> str:
+        """Хэш файла весов .h5 (первые 12 символов)"""
+        if self._weights_hash is None:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(self.model_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self._weights_hash = digest.hexdigest()[:12]
+        return self._weights_hash
+    
+    def converted_path(self, ext: str, quantization: Optional[str] = None) -> str:
+        """Путь к сконвертированной модели рядом с исходным .h5
+        
+        В имени - хэш весов: после замены .h5 модель конвертируется заново,
+        а не берётся устаревший файл.
+        """
+        root = os.path.splitext(self.model_path)[0]
+        suffix = f".{quantization}" if quantization else ""
+        return f"{root}.{self.weights_hash}{suffix}.{ext}"
+    
+    def _load_keras(self):
+        import tensorflow as tf
+        return tf.keras.models.load_model(self.model_path, compile=False)
+
+
+class KerasBackend(InferenceBackend):
+    """Полная модель Keras, вызов через tf.function"""
+    
+    name = "keras"
+    
+    def import_runtime(self):
+        import tensorflow
+    
+    def load(self):
+        import tensorflow as tf
+        
+        if self.quantization:
+            raise ValueError("Квантизация поддерживается только бэкендами tflite и onnx")
+        model = self._load_keras()
+        
+        # Прямой вызов модели без накладных расходов predict
+        @tf.function(input_signature=[tf.TensorSpec([None, self.patch_size, self.patch_size, 3], tf.float32)])
+        def infer(x):
+            return model(x, training=False)
+        
+        self.model = model
+        self._infer = infer
+    
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self._infer(batch.astype(np.float32, copy=False)).numpy()
+
+
+class TFLiteBackend(InferenceBackend):
+    """TFLite интерпретатор; модель конвертируется из .h5 при первом запуске
+    
+    Для работы без TensorFlow достаточно уже сконвертированного файла и
+    пакета ai-edge-litert (или tflite-runtime).
+    """
+    
+    name = "tflite"
+    
+    def import_runtime(self):
+        if not os.path.exists(self.converted_path("tflite", self.quantization)):
+            import tensorflow  # Понадобится для конвертации
+        self._interpreter_class()
+    
+    def _interpreter_class(self):
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                from tensorflow.lite import Interpreter
+        return Interpreter
+    
+    def convert(self) -> str:
+        import tensorflow as tf
+        
+        converter = tf.lite.TFLiteConverter.from_keras_model(self._load_keras())
+        if self.quantization == "float16":
+            # Веса во float16, вычисления во float32
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        
+        path = self.converted_path("tflite", self.quantization)
+        with open(path, 'wb') as f:
+            f.write(converter.convert())
+        return path
+    
+    def load(self):
+        path = self.converted_path("tflite", self.quantization)
+        if not os.path.exists(path):
+            self.convert()
+        
+        self._interpreter = self._interpreter_class()(model_path=path, num_threads=os.cpu_count())
+        self._input = self._interpreter.get_input_details()[0]['index']
+        self._output = self._interpreter.get_output_details()[0]['index']
+        self._batch = None
+        # Интерпретатор не потокобезопасен
+        self._lock = threading.Lock()
+    
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        with self._lock:
+            if self._batch != len(batch):
+                self._interpreter.resize_tensor_input(self._input, batch.shape)
+                self._interpreter.allocate_tensors()
+                self._batch = len(batch)
+            self._interpreter.set_tensor(self._input, batch.astype(np.float32, copy=False))
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output).copy()
+
+
+class OnnxBackend(InferenceBackend):
+    """ONNX Runtime; модель конвертируется из .h5 через tf2onnx при первом запуске"""
+    
+    name = "onnx"
+    
+    def import_runtime(self):
+        if not os.path.exists(self.converted_path("onnx", self.quantization)):
+            import tensorflow  # Понадобится для конвертации
+        import onnxruntime
+    
+    def convert(self) -> str:
+        import tensorflow as tf
+        import tf2onnx
+        
+        model = self._load_keras()
+        spec = (tf.TensorSpec((None, self.patch_size, self.patch_size, 3), tf.float32, name="input"),)
+        
+        @tf.function
+        def infer(x):
+            return model(x, training=False)
+        
+        # Неквантизованная модель - основа для квантизованных вариантов
+        base_path = self.converted_path("onnx")
+        if not os.path.exists(base_path):
+            tf2onnx.convert.from_function(infer, input_signature=spec, output_path=base_path)
+        
+        path = self.converted_path("onnx", self.quantization)
+        if self.quantization == "float16":
+            import onnx
+            try:
+                from onnxconverter_common import float16
+            except ImportError as e:
+                raise ImportError("Для float16 в onnx нужен пакет onnxconverter-common") from e
+            onnx.save(float16.convert_float_to_float16(onnx.load(base_path), keep_io_types=True), path)
+        return path
+    
+    def load(self):
+        import onnxruntime as ort
+        
+        path = self.converted_path("onnx", self.quantization)
+        if not os.path.exists(path):
+            self.convert()
+        
+        self._session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self._input = self._session.get_inputs()[0].name
+    
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self._session.run(None, {self._input: batch.astype(np.float32, copy=False)})[0]
+
+
+BACKENDS = {
+    KerasBackend.name: KerasBackend,
+    TFLiteBackend.name: TFLiteBackend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+
+def create_backend(name: str, model_path: str, patch_size: int = 64,
+                   quantization: Optional[str] = None) -> InferenceBackend:
+    """Создание бэкенда по имени из конфигурации"""
+    if name not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд: {name}. Доступны: {', '.join(BACKENDS)}")
+    return BACKENDS[name](model_path, patch_size, quantization)
+
+
+def check_parity(backend: InferenceBackend, reference: InferenceBackend,
+                 patches: Optional[np.ndarray] = None, n_samples: int = 256,
+                 seed: int = 0) -> Dict[str, float]:
+    """Сравнение предсказаний бэкенда с эталонным (обычно Keras)
+    
+    Без patches используются случайные патчи с фиксированным seed.
+    """
+    if patches is None:
+        rng = np.random.default_rng(seed)
+        patches = rng.random((n_samples, backend.patch_size, backend.patch_size, 3), dtype=np.float32)
+    
+    probs = backend.predict(patches)
+    expected = reference.predict(patches)
+    return {
+        "samples": len(patches),
+        "max_abs_diff": float(np.abs(probs - expected).max()),
+        "argmax_agreement": float((probs.argmax(axis=1) == expected.argmax(axis=1)).mean()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конвертация модели и проверка совпадения с Keras")
+    parser.add_argument("--model", default="models/best_eurosat_model.h5")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="tflite")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default=None)
+    parser.add_argument("--image", help="Снимок, патчи которого используются для сравнения")
+    parser.add_argument("--min-agreement", type=float, default=0.99,
+                        help="Минимальная доля совпадающих классов")
+    args = parser.parse_args()
+    
+    backend = create_backend(args.backend, args.model, quantization=args.quantization)
+    reference = create_backend("keras", args.model)
+    backend.load()
+    reference.load()
+    
+    patches = None
+    if args.image:
+        from classifier import EuroSATClassifier
+        classifier = EuroSATClassifier(args.model)
+        data = classifier.process_raster(args.image)[0]
+        ps = classifier.patch_size
+        h, w = data.shape[0] // ps * ps, data.shape[1] // ps * ps
+        patches = data[:h, :w].reshape(h // ps, ps, w // ps, ps, 3).transpose(0, 2, 1, 3, 4).reshape(-1, ps, ps, 3)
+    
+    result = check_parity(backend, reference, patches)
+    print(json.dumps(result, indent=2))
+    if result["argmax_agreement"] < args.min_agreement:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
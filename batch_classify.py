@@ -0,0 +1,296 @@
+# batch_classify.py
+"""Пакетная классификация каталога или списка снимков без HTTP
+
+Запуск:
+    python batch_classify.py tiles/ --output results/
+    python batch_classify.py --file-list tiles.txt --output results/ --outputs geotiff
+
+Чтение, нормализация, инференс и запись результатов идут в отдельных
+потоках, связанных очередями ограниченного размера, поэтому в памяти
+одновременно находится не больше нескольких снимков на этап. Патчи из
+разных снимков объединяются в общие батчи (см. MicroBatcher).
+
+Обработанные снимки записываются в manifest.jsonl в каталоге результатов;
+при повторном запуске они пропускаются, а снимки с ошибками
+обрабатываются заново.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from backends import BACKENDS, QUANTIZATIONS
+from classifier import ARTIFACTS, EuroSATClassifier
+
+# Расширения файлов результатов
+EXTENSIONS = {
+    "visualization": ".png", "geotiff": ".tif", "geojson": ".geojson",
+    "flatgeobuf": ".fgb", "gpkg": ".gpkg",
+}
+MANIFEST = "manifest.jsonl"
+# Сигнал завершения, проходящий по очередям вслед за последним снимком
+_DONE = object()
+
+
+class Tile:
+    """Снимок, передаваемый между этапами конвейера"""
+    
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name  # Путь результатов относительно каталога вывода, без расширения
+        self.size = 0
+        self.data = None
+        self.meta: Optional[tuple] = None  # profile, transform, crs
+        self.class_map: Optional[tuple] = None
+        self.outputs: List[str] = []
+        self.error: Optional[str] = None
+        self.started = time.perf_counter()
+
+
+def find_inputs(inputs: Iterable[str], patterns: List[str]) -> List[Tile]:
+    """Снимки из файлов и каталогов (рекурсивно, по маскам имён)
+    
+    Файл из списка получает имя без каталога, из каталога - путь относительно
+    него. Разные снимки с одинаковым именем перезаписали бы результаты друг
+    друга, поэтому вызывают ValueError; повтор одного файла отбрасывается.
+    """
+    tiles = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for file_name in sorted(files):
+                    if any(fnmatch.fnmatch(file_name.lower(), p) for p in patterns):
+                        path = os.path.join(root, file_name)
+                        tiles.append(Tile(path, os.path.splitext(os.path.relpath(path, item))[0]))
+        else:
+            tiles.append(Tile(item, os.path.splitext(os.path.basename(item))[0]))
+    
+    unique: Dict[str, Tile] = {}
+    for tile in tiles:
+        unique.setdefault(os.path.realpath(tile.path), tile)
+    names: Dict[str, Tile] = {}
+    for tile in unique.values():
+        other = names.setdefault(tile.name, tile)
+        if other is not tile:
+            raise ValueError(f"Снимки {other.path} и {tile.path} дают одно имя результатов: {tile.name}")
+    return list(unique.values())
+
+
+def load_manifest(path: str) -> Dict[str, dict]:
+    """Последняя запись манифеста для каждого снимка"""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Недописанная строка при прерывании
+            records[record["input"]] = record
+    return records
+
+
+def start_stage(name: str, fn: Callable[[Tile], None], inbox: queue.Queue,
+                outbox: queue.Queue, workers: int) -> List[threading.Thread]:
+    """Потоки этапа: fn для каждого снимка из inbox, результат в outbox
+    
+    Снимки с ошибкой передаются дальше без обработки, чтобы попасть в
+    манифест. Последний завершившийся поток передаёт _DONE следующему этапу.
+    """
+    remaining = [workers]
+    lock = threading.Lock()
+    
+    def loop():
+        while True:
+            tile = inbox.get()
+            if tile is _DONE:
+                inbox.put(_DONE)  # Для остальных потоков этапа
+                break
+            if tile.error is None:
+                try:
+                    fn(tile)
+                except Exception as e:
+                    tile.error = f"{name}: {e}"
+                    tile.data = tile.class_map = None
+            outbox.put(tile)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            outbox.put(_DONE)
+    
+    threads = [threading.Thread(target=loop, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def write_atomic(path: str, value):
+    """Запись результата через временный файл"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(value.encode('utf-8') if isinstance(value, str) else value)
+    os.replace(tmp_path, path)
+
+
+def run_batch(classifier: EuroSATClassifier, tiles: List[Tile], output_dir: str,
+              channels: Optional[str] = None, outputs: Iterable[str] = ("geotiff", "geojson"),
+              stride: Optional[int] = None, readers: int = 4, infer_threads: int = 2,
+              writers: int = 2, queue_size: int = 8, report_every: float = 10.0) -> dict:
+    """Классификация снимков конвейером с записью манифеста
+    
+    Модель должна быть загружена. Возвращает сводку с пропускной способностью.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    done = {path for path, record in load_manifest(manifest_path).items() if record["status"] == "done"}
+    pending = [tile for tile in tiles if tile.path not in done]
+    outputs = list(outputs)
+    
+    def read(tile):
+        tile.size = os.path.getsize(tile.path)
+        tile.data, profile, transform, crs = classifier.read_raster(tile.path, channels)
+        tile.meta = (profile, transform, crs)
+    
+    def normalize(tile):
+        tile.data = classifier.normalize(tile.data)
+    
+    def infer(tile):
+        grid = classifier.classify_grid(tile.data, stride=stride)
+        tile.data = None  # Снимок больше не нужен - освобождаем память до записи
+        tile.class_map = (grid,) + tile.meta + (stride or classifier.patch_size,)
+    
+    def write(tile):
+        for name in outputs:
+            path = os.path.join(output_dir, tile.name + EXTENSIONS[name])
+            write_atomic(path, classifier.render_artifact(name, *tile.class_map))
+            tile.outputs.append(os.path.relpath(path, output_dir))
+        tile.class_map = None
+    
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(5)]
+    stages = [("read", read, readers), ("normalize", normalize, 1),
+              ("infer", infer, infer_threads), ("write", write, writers)]
+    for i, (name, fn, workers) in enumerate(stages):
+        start_stage(name, fn, queues[i], queues[i + 1], workers)
+    
+    def feed():
+        for tile in pending:
+            tile.started = time.perf_counter()
+            queues[0].put(tile)
+        queues[0].put(_DONE)
+    
+    threading.Thread(target=feed, name="feeder", daemon=True).start()
+    
+    started = time.perf_counter()
+    last_report = started
+    n_done = n_failed = n_bytes = 0
+    with open(manifest_path, 'a', encoding='utf-8') as manifest:
+        while True:
+            tile = queues[-1].get()
+            if tile is _DONE:
+                break
+            
+            record = {"input": tile.path, "status": "error" if tile.error else "done",
+                      "seconds": round(time.perf_counter() - tile.started, 3)}
+            if tile.error:
+                record["error"] = tile.error
+                n_failed += 1
+            else:
+                record["outputs"] = tile.outputs
+                n_done += 1
+                n_bytes += tile.size
+            # Запись в манифест после результатов - при прерывании снимок обработается заново
+            manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            manifest.flush()
+            
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                last_report = now
+                elapsed = now - started
+                print(f"{n_done + n_failed}/{len(pending)} снимков, "
+                      f"{n_done / elapsed:.1f} снимков/с, {n_bytes / elapsed / 1e6:.1f} МБ/с", file=sys.stderr)
+    
+    elapsed = time.perf_counter() - started
+    return {
+        "total": len(tiles),
+        "skipped": len(tiles) - len(pending),
+        "done": n_done,
+        "failed": n_failed,
+        "seconds": round(elapsed, 3),
+        "tiles_per_second": round(n_done / elapsed, 2) if elapsed else 0.0,
+        "mb_per_second": round(n_bytes / elapsed / 1e6, 2) if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная классификация снимков EuroSAT")
+    parser.add_argument("inputs", nargs="*", help="Файлы и каталоги со снимками")
+    parser.add_argument("--file-list", help="Файл со списком снимков, по одному пути в строке")
+    parser.add_argument("--output", required=True, help="Каталог результатов и манифеста")
+    parser.add_argument("--pattern", default="*.tif,*.tiff", help="Маски имён файлов в каталогах")
+    parser.add_argument("--channels", default=None, help="Каналы через запятую")
+    parser.add_argument("--outputs", default="geotiff,geojson",
+                        help=f"Результаты через запятую: {','.join(ARTIFACTS)}")
+    parser.add_argument("--stride", type=int, default=None, help="Шаг окна для классификации с перекрытием")
+    parser.add_argument("--simplify", type=float, default=0.0,
+                        help="Допуск упрощения векторных результатов в пикселях снимка")
+    parser.add_argument("--model", default="models/best_eurosat_model.h5")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="keras")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-latency-ms", type=float, default=5.0)
+    parser.add_argument("--readers", type=int, default=4, help="Потоки чтения")
+    parser.add_argument("--infer-threads", type=int, default=2, help="Потоки инференса")
+    parser.add_argument("--writers", type=int, default=2, help="Потоки записи результатов")
+    parser.add_argument("--queue-size", type=int, default=8, help="Размер очередей между этапами")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Интервал вывода прогресса, секунды")
+    args = parser.parse_args()
+    
+    outputs = [name.strip() for name in args.outputs.split(',') if name.strip()]
+    unknown = [name for name in outputs if name not in ARTIFACTS]
+    if unknown:
+        parser.error(f"Неизвестные результаты: {', '.join(unknown)}")
+    if args.stride is not None and (args.stride <= 0 or 64 % args.stride):
+        parser.error("--stride должен быть делителем размера патча 64")
+    
+    inputs = list(args.inputs)
+    if args.file_list:
+        with open(args.file_list, encoding='utf-8') as f:
+            inputs.extend(line.strip() for line in f if line.strip())
+    if not inputs:
+        parser.error("Не указаны снимки")
+    try:
+        tiles = find_inputs(inputs, [p.strip().lower() for p in args.pattern.split(',')])
+    except ValueError as e:
+        parser.error(str(e))
+    
+    classifier = EuroSATClassifier(args.model, batch_size=args.batch_size, backend=args.backend,
+                                   quantization=args.quantization, simplify=args.simplify)
+    classifier.load_model()
+    if args.infer_threads > 1:
+        classifier.enable_batching(max_latency=args.batch_latency_ms / 1000)
+    
+    try:
+        summary = run_batch(
+            classifier, tiles, args.output, channels=args.channels, outputs=outputs,
+            stride=args.stride, readers=args.readers, infer_threads=args.infer_threads,
+            writers=args.writers, queue_size=args.queue_size, report_every=args.report_every
+        )
+    finally:
+        if classifier.batcher:
+            classifier.batcher.close()
+    print(json.dumps(summary, indent=2))
+    if summary["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# batching.py
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Объединение патчей из параллельных запросов в общие батчи
+    
+    Вызовы predict() из разных потоков попадают в одну очередь. Фоновый
+    поток собирает их в батч до batch_size патчей или до истечения
+    max_latency с момента первого ожидающего вызова, выполняет один
+    predict_fn и раздаёт результаты вызывающим.
+    """
+    
+    def __init__(self, predict_fn: Callable[[np.ndarray], np.ndarray],
+                 batch_size: int = 64, max_latency: float = 0.005):
+        self.predict_fn = predict_fn
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.patches = 0
+        self.requests = 0
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+    
+    def predict(self, patches: np.ndarray) -> np.ndarray:
+        """Вероятности классов для патчей (блокирует до готовности батча)"""
+        future = Future()
+        self._queue.put((patches, future))
+        return future.result()
+    
+    def _collect(self, first) -> list:
+        """Сбор вызовов в батч до заполнения или дедлайна"""
+        pending = [first]
+        count = len(first[0])
+        deadline = time.monotonic() + self.max_latency
+        
+        while count < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # Остановка после текущего батча
+                break
+            pending.append(item)
+            count += len(item[0])
+        return pending
+    
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            pending = self._collect(item)
+            
+            try:
+                batch = np.concatenate([patches for patches, _ in pending])
+                probs = self.predict_fn(batch)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            
+            with self._lock:
+                self.batches += 1
+                self.patches += len(batch)
+                self.requests += len(pending)
+            
+            offset = 0
+            for patches, future in pending:
+                future.set_result(probs[offset:offset + len(patches)])
+                offset += len(patches)
+    
+    def stats(self) -> Dict[str, float]:
+        """Число и средняя заполненность батчей"""
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "patches": self.patches,
+                "requests": self.requests,
+                "avg_batch": self.patches / self.batches if self.batches else 0.0,
+            }
+    
+    def close(self):
+        """Остановка фонового потока"""
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,321 @@
+# benchmark.py
+"""Бенчмарк пайплайна классификации на синтетических снимках
+
+Запуск:
+    python benchmark.py stages --backend synthetic --output bench.json
+    python benchmark.py stages --model models/best_eurosat_model.h5 --compare bench.json
+    python benchmark.py load --url http://localhost:8000 --endpoint classify_all --concurrency 8
+
+Режим stages генерирует многоканальные GeoTIFF и JPG/PNG нескольких размеров,
+замеряет время каждого этапа (минимум и медиана по повторам) и пиковый RSS
+процесса во время этапа. Бэкенд synthetic - детерминированная модель на numpy
+без файла весов, для замеров всего, кроме инференса. Режим load отправляет
+параллельные запросы к запущенному серверу.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from backends import BACKENDS, InferenceBackend, QUANTIZATIONS
+from classifier import ARTIFACTS, EuroSATClassifier
+
+FORMATS = ("tif", "jpg", "png")
+
+
+class SyntheticBackend(InferenceBackend):
+    """Модель-заглушка: линейный слой по средним значениям каналов патча"""
+    
+    name = "synthetic"
+    
+    def load(self):
+        rng = np.random.default_rng(0)
+        self.weights = rng.normal(size=(3, 10)).astype(np.float32) * 8
+        self.bias = rng.normal(size=10).astype(np.float32)
+    
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        logits = batch.mean(axis=(1, 2)) @ self.weights + self.bias
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+
+BACKENDS.setdefault(SyntheticBackend.name, SyntheticBackend)
+
+
+def make_raster(path: str, size: int, fmt: str = "tif", bands: int = 4, seed: int = 0) -> str:
+    """Синтетический снимок: блоки разной яркости с шумом
+    
+    Блоки дают реалистичное число полигонов в GeoJSON, шум - нетривиальное
+    сжатие. GeoTIFF - uint16 с bands каналами и привязкой UTM, JPG/PNG - RGB.
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    base = ((yy // 97 + xx // 131) % 7).astype(np.float32) / 6
+    
+    if fmt == "tif":
+        import rasterio
+        from rasterio.transform import from_origin
+        
+        data = np.stack([
+            (base * (i + 1) * 1500 + 300 + rng.integers(0, 400, (size, size))).astype(np.uint16)
+            for i in range(bands)
+        ])
+        profile = {
+            'driver': 'GTiff', 'height': size, 'width': size, 'count': bands, 'dtype': 'uint16',
+            'crs': 'EPSG:32633', 'transform': from_origin(500000, 5000000, 10, 10),
+            'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'lzw',
+        }
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(data)
+    else:
+        from PIL import Image
+        
+        data = np.stack([base * 200 + rng.integers(0, 50, (size, size)) for _ in range(3)], axis=2)
+        Image.fromarray(data.astype(np.uint8)).save(path, format='JPEG' if fmt == "jpg" else 'PNG')
+    return path
+
+
+def current_rss() -> int:
+    """Текущий RSS процесса в байтах (Linux), иначе пиковый за всё время"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def track_peak_rss(interval: float = 0.002):
+    """Пиковый RSS во время блока; результат в словаре после выхода"""
+    result = {"peak": current_rss()}
+    stop = threading.Event()
+    
+    def sample():
+        while not stop.wait(interval):
+            result["peak"] = max(result["peak"], current_rss())
+    
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        thread.join()
+        result["peak"] = max(result["peak"], current_rss())
+
+
+def measure(fn: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None) -> dict:
+    """Время (минимум и медиана) и пиковый RSS этапа; setup - перед каждым повтором"""
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with track_peak_rss() as rss:
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        peak = max(peak, rss["peak"])
+    return {
+        "seconds_min": round(min(times), 5),
+        "seconds_median": round(statistics.median(times), 5),
+        "peak_rss_mb": round(peak / 2**20, 1),
+    }
+
+
+def bench_file(classifier: EuroSATClassifier, path: str, fmt: str, repeat: int) -> Dict[str, dict]:
+    """Замер этапов пайплайна для одного снимка"""
+    stages = {}
+    stages["content_hash"] = measure(lambda: classifier.content_hash(path), repeat)
+    # Статистики нормализации кэшируются по хэшу файла - сбрасываем, чтобы замерять полное чтение
+    stages["process_raster"] = measure(lambda: classifier.process_raster(path), repeat,
+                                       setup=classifier._stats_cache.clear)
+    stages["create_preview"] = measure(lambda: classifier.create_preview(path), repeat)
+    
+    data, profile, transform, crs = classifier.process_raster(path)
+    stages["classify_grid"] = measure(lambda: classifier.classify_grid(data.copy()), repeat)
+    stages["classify_fast"] = measure(lambda: classifier.classify_fast(data.copy()), repeat)
+    
+    grid = classifier.classify_grid(data)
+    for name in ARTIFACTS:
+        stages[f"create_{name}"] = measure(
+            lambda: classifier.render_artifact(name, grid, profile, transform, crs, classifier.patch_size), repeat
+        )
+    
+    if fmt == "tif":
+        fd, output_path = tempfile.mkstemp(suffix=".tif")
+        os.close(fd)
+        try:
+            stages["classify_windowed"] = measure(lambda: classifier.classify_windowed(path, output_path), repeat,
+                                                  setup=classifier._stats_cache.clear)
+        finally:
+            os.remove(output_path)
+    return stages
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stages(args) -> dict:
+    """Режим stages: замер этапов на синтетических снимках"""
+    # Без кэша: каждый повтор выполняет полную работу
+    classifier = EuroSATClassifier(args.model, batch_size=args.batch_size,
+                                   backend=args.backend, quantization=args.quantization)
+    classifier.load_model()
+    
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            for fmt in args.formats:
+                path = make_raster(os.path.join(tmp, f"synthetic_{size}.{fmt}"), size, fmt)
+                print(f"{fmt} {size}x{size}...", flush=True)
+                for stage, timing in bench_file(classifier, path, fmt, args.repeat).items():
+                    results.append({"format": fmt, "size": size, "stage": stage, **timing})
+    
+    return {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "backend": args.backend,
+        "quantization": args.quantization,
+        "batch_size": args.batch_size,
+        "repeat": args.repeat,
+        "timings": classifier.timings,
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict):
+    """Таблица изменения медианного времени относительно прошлого запуска"""
+    previous = {(r["format"], r["size"], r["stage"]): r for r in baseline["results"]}
+    print(f"\nСравнение с {baseline.get('commit') or 'базовым запуском'}:")
+    print(f"{'этап':<36}{'было, с':>10}{'стало, с':>10}{'x':>8}")
+    for r in current["results"]:
+        old = previous.get((r["format"], r["size"], r["stage"]))
+        if old is None:
+            continue
+        ratio = r["seconds_median"] / old["seconds_median"] if old["seconds_median"] else float("nan")
+        label = f"{r['format']} {r['size']} {r['stage']}"
+        print(f"{label:<36}{old['seconds_median']:>10.4f}{r['seconds_median']:>10.4f}{ratio:>8.2f}")
+
+
+def run_load(args) -> dict:
+    """Режим load: параллельные запросы к запущенному серверу"""
+    import requests
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_raster(os.path.join(tmp, f"synthetic.{args.format}"), args.size, args.format)
+        with open(path, 'rb') as f:
+            payload = f.read()
+    
+    url = f"{args.url.rstrip('/')}/{args.endpoint.strip('/')}/"
+    if args.endpoint.startswith("classify/"):
+        url = url.rstrip('/')
+    
+    def send(i: int):
+        # Разные байты в конце файла обходят кэш сервера, если задан --unique
+        body = payload + i.to_bytes(8, 'little') if args.unique else payload
+        start = time.perf_counter()
+        try:
+            response = requests.post(url, files={"file": (f"synthetic.{args.format}", body)}, timeout=args.timeout)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        return status, time.perf_counter() - start
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        responses = list(executor.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    
+    # 202 - задача поставлена в очередь (/jobs/)
+    latencies = sorted(latency for status, latency in responses if status in (200, 202))
+    statuses: Dict[str, int] = {}
+    for status, _ in responses:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    
+    def percentile(q: float) -> Optional[float]:
+        return round(float(np.percentile(latencies, q)), 4) if latencies else None
+    
+    return {
+        "url": url,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "upload_mb": round(len(payload) / 2**20, 2),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 2),
+        "latency_p50": percentile(50),
+        "latency_p95": percentile(95),
+        "latency_p99": percentile(99),
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк пайплайна классификации EuroSAT")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    
+    stages = subparsers.add_parser("stages", help="Замер этапов пайплайна")
+    stages.add_argument("--model", default="models/best_eurosat_model.h5")
+    stages.add_argument("--backend", choices=list(BACKENDS), default="synthetic")
+    stages.add_argument("--quantization", choices=QUANTIZATIONS, default=None)
+    stages.add_argument("--batch-size", type=int, default=64)
+    stages.add_argument("--sizes", type=lambda s: [int(v) for v in s.split(',')], default=[512, 2048],
+                        help="Размеры снимков через запятую")
+    stages.add_argument("--formats", type=lambda s: s.split(','), default=list(FORMATS),
+                        help=f"Форматы через запятую: {','.join(FORMATS)}")
+    stages.add_argument("--repeat", type=int, default=3)
+    stages.add_argument("--compare", help="JSON прошлого запуска для сравнения")
+    
+    load = subparsers.add_parser("load", help="Нагрузочный тест эндпоинтов")
+    load.add_argument("--url", default="http://localhost:8000")
+    load.add_argument("--endpoint", default="classify_all",
+                      help="check_channels, get_preview, classify_all, classify/geotiff, jobs, ...")
+    load.add_argument("--size", type=int, default=1024)
+    load.add_argument("--format", choices=FORMATS, default="tif")
+    load.add_argument("--requests", type=int, default=50)
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--timeout", type=float, default=300)
+    load.add_argument("--unique", action="store_true", help="Разные файлы в каждом запросе (без кэша)")
+    
+    for sub in (stages, load):
+        sub.add_argument("--output", help="Файл для сохранения результатов JSON")
+    args = parser.parse_args()
+    
+    result = run_stages(args) if args.mode == "stages" else run_load(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    
+    if args.mode == "stages":
+        for r in result["results"]:
+            label = f"{r['format']} {r['size']} {r['stage']}"
+            print(f"{label:<36}{r['seconds_median']:>10.4f} с{r['peak_rss_mb']:>10.1f} МБ")
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                compare(result, json.load(f))
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
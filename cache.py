@@ -0,0 +1,95 @@
+# cache.py
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import numpy as np
+
+
+def _sizeof(value: Any) -> int:
+    """Оценка объёма значения в байтах"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением по объёму и числу записей"""
+    
+    def __init__(self, max_bytes: Optional[int] = None, max_items: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Получение значения с обновлением порядка использования"""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+    
+    def put(self, key: Hashable, value: Any) -> None:
+        """Сохранение значения с вытеснением самых старых записей"""
+        size = _sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # Значение больше всего кэша - не храним
+        
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._sizes.pop(key)
+                del self._data[key]
+            self._data[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            
+            while self._data and (
+                (self.max_bytes is not None and self._bytes > self.max_bytes) or
+                (self.max_items is not None and len(self._data) > self.max_items)
+            ):
+                old_key, _ = self._data.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+    
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Значение из кэша или результат compute() с сохранением"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+    
+    def clear(self) -> None:
+        """Очистка кэша"""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+    
+    def stats(self) -> Dict[str, int]:
+        """Счётчики попаданий и заполненность"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "items": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
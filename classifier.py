@@ -1,23 +1,67 @@
 # classifier.py
+# Тяжёлые библиотеки (rasterio, PIL, shapely, рантайм модели) импортируются
+# при первом использовании, чтобы импорт модуля и старт сервера были быстрыми
 import numpy as np
-import tensorflow as tf
-from PIL import Image
 import io
-import rasterio
-from rasterio.io import MemoryFile
-from rasterio.features import shapes
+import os
+from numpy.lib.stride_tricks import sliding_window_view
+from contextlib import contextmanager
+import hashlib
+import time
 import json
 import base64
-from typing import Tuple, Dict, Optional
+from typing import Tuple, Dict, Optional, List, Union, Callable, Iterable, Iterator
+from cache import LRUCache
+from batching import MicroBatcher
+from backends import create_backend
+from metrics import metrics
+
+# Источник растра: байты загруженного файла или путь к файлу на диске
+RasterSource = Union[bytes, str]
+# Результаты классификации, которые можно запросить
+ARTIFACTS = ("visualization", "geotiff", "geojson", "flatgeobuf", "gpkg")
+# Результаты по умолчанию
+DEFAULT_ARTIFACTS = ("visualization", "geotiff", "geojson")
+# Драйверы GDAL для двоичных векторных форматов
+VECTOR_DRIVERS = {"flatgeobuf": "FlatGeobuf", "gpkg": "GPKG"}
+# Cloud-Optimized GeoTIFF: тайлы 256x256 и внутренние обзоры, читается по Range-запросам
+COG_OPTIONS = {
+    'driver': 'COG', 'compress': 'deflate', 'blocksize': 256,
+    'overview_resampling': 'nearest', 'BIGTIFF': 'IF_SAFER'
+}
+# Половина длины экватора в метрах Web Mercator (границы сетки XYZ)
+WEB_MERCATOR_HALF = 20037508.342789244
+# Вещественные растры больше этого размера по стороне: статистика нормализации
+# по прореженному чтению
+STATS_SAMPLE_SIZE = 2048
+# Колбэк прогресса: (обработано патчей, всего патчей)
+ProgressCallback = Callable[[int, int], None]
 
 class EuroSATClassifier:
     """Оптимизированный классификатор для спутниковых изображений EuroSAT"""
     
-    def __init__(self, model_path: str, patch_size: int = 64, batch_size: int = 64):
+    def __init__(self, model_path: str, patch_size: int = 64, batch_size: int = 64,
+                 cache: Optional[LRUCache] = None, backend: str = "keras",
+                 quantization: Optional[str] = None, simplify: float = 0.0):
         self.model_path = model_path
         self.patch_size = patch_size
         self.batch_size = batch_size  # Увеличен для скорости
+        # Бэкенд инференса: keras, tflite или onnx (см. backends.py)
+        self.backend = backend
+        self.quantization = quantization
+        # Допуск упрощения векторных результатов в пикселях снимка (0 - без упрощения)
+        self.simplify = simplify
         self.model = None
+        self._model_version = None
+        # Время этапов запуска: импорт, загрузка, прогрев (секунды)
+        self.timings: Dict[str, float] = {}
+        # Объединение патчей из параллельных запросов (см. enable_batching)
+        self.batcher = None
+        
+        # Кэш декодированных растров (общий с сервером, если передан)
+        self.cache = cache
+        # Кэш статистик нормализации: (хэш файла, каналы) -> границы 2-98%
+        self._stats_cache = LRUCache(max_items=64)
         
         # Цвета и названия классов
         self.class_colors = {
@@ -34,50 +78,258 @@ class EuroSATClassifier:
     def load_model(self):
         """Загрузка и прогрев модели"""
         if self.model is None:
-            self.model = tf.keras.models.load_model(self.model_path)
+            start = time.perf_counter()
+            model = create_backend(self.backend, self.model_path, self.patch_size, self.quantization)
+            model.import_runtime()
+            self.import_io()
+            loaded = time.perf_counter()
+            model.load()
+            warmed = time.perf_counter()
             # Прогрев модели
-            self.model.predict(np.zeros((1, self.patch_size, self.patch_size, 3), dtype=np.float32), verbose=0)
+            model.predict(np.zeros((1, self.patch_size, self.patch_size, 3), dtype=np.float32))
+            self.timings.update({
+                "import": loaded - start,
+                "load": warmed - loaded,
+                "warmup": time.perf_counter() - warmed,
+            })
+            self.model = model
+    
+    def import_io(self):
+        """Предзагрузка библиотек чтения растров и векторизации"""
+        import rasterio
+        import rasterio.features
+        import shapely
+        from PIL import Image
+    
+    def _infer(self, batch: np.ndarray) -> np.ndarray:
+        """Вероятности классов для батча патчей"""
+        return self.model.predict(batch)
+    
+    def enable_batching(self, max_latency: float = 0.005):
+        """Включение общего батчинга патчей между потоками"""
+        if self.batcher is None:
+            self.batcher = MicroBatcher(self._infer, self.batch_size, max_latency)
+    
+    def predict_batch(self, batch: np.ndarray) -> np.ndarray:
+        """Вероятности классов через общий батчер или напрямую"""
+        metrics.inc("patches_predicted_total", len(batch))
+        # С батчером время включает ожидание сборки общего батча
+        with metrics.stage("predict"):
+            if self.batcher is not None:
+                return self.batcher.predict(batch)
+            return self._infer(batch)
+    
+    @property
+    def model_version(self) -> str:
+        """Версия модели - хэш файла весов, бэкенд и квантизация"""
+        if self._model_version is None:
+            self._model_version = f"{self.content_hash(self.model_path)}:{self.backend}:{self.quantization or 'fp32'}"
+        return self._model_version
     
-    def check_channels(self, file_bytes: bytes) -> int:
+    def check_channels(self, file_bytes: RasterSource) -> int:
         """Проверка количества каналов в файле"""
         try:
-            with MemoryFile(file_bytes) as memfile:
-                with memfile.open() as src:
-                    return src.count
+            with self._open_raster(file_bytes) as src:
+                return src.count
         except:
             return 3  # Обычное RGB изображение
     
-    def process_raster(self, file_bytes: bytes, channels_str: Optional[str] = None) -> Tuple[np.ndarray, dict, object, object]:
+    @contextmanager
+    def _open_raster(self, source: RasterSource):
+        """Открытие растра из байтов или по пути"""
+        from rasterio.io import MemoryFile
+        import rasterio
+        
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            with MemoryFile(source) as memfile:
+                with memfile.open() as src:
+                    yield src
+        else:
+            with rasterio.open(source) as src:
+                yield src
+    
+    def _select_channels(self, src, channels_str: Optional[str]) -> List[int]:
+        """Выбор каналов для RGB композита"""
+        if channels_str and src.count > 3:
+            return [min(max(1, int(ch)), src.count) for ch in channels_str.split(',')[:3]]
+        return [1, 2, 3] if src.count >= 3 else [1] * 3
+    
+    def _read_channels(self, src, channels: List[int], **kwargs) -> np.ndarray:
+        """Чтение каналов в формате HxWx3 float32"""
+        return self._as_float(src.read(channels, **kwargs))
+    
+    def _as_float(self, raw: np.ndarray) -> np.ndarray:
+        """Каналы CxHxW из rasterio в HxWx3 float32 без NaN и бесконечностей"""
+        data = raw.transpose(1, 2, 0).astype(np.float32)
+        if np.issubdtype(raw.dtype, np.integer):
+            return data
+        return np.nan_to_num(data, copy=False, nan=0.0, posinf=255.0, neginf=0.0)
+    
+    def content_hash(self, source: RasterSource) -> str:
+        """Хэш содержимого файла для ключей кэша"""
+        digest = hashlib.blake2b(digest_size=16)
+        with metrics.stage("hash"):
+            if isinstance(source, str):
+                with open(source, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(chunk)
+            else:
+                digest.update(source)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _counted_dtype(dtype) -> bool:
+        """Целочисленный тип до 16 бит - границы считаются по гистограмме всех значений"""
+        return np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2
+    
+    @staticmethod
+    def _value_counts(band: np.ndarray) -> np.ndarray:
+        """Число пикселей каждого положительного значения канала (8 или 16 бит)"""
+        # Знаковые значения считаются как беззнаковые: отрицательные попадают выше максимума типа
+        unsigned = np.ascontiguousarray(band).view(f"u{band.dtype.itemsize}").ravel()
+        counts = np.bincount(unsigned, minlength=256 ** band.dtype.itemsize)[:np.iinfo(band.dtype).max + 1]
+        counts[0] = 0
+        return counts
+    
+    @staticmethod
+    def _counts_bounds(counts: np.ndarray) -> Optional[Tuple[float, float]]:
+        """Границы 2-98% по гистограмме значений - как np.percentile по положительным значениям"""
+        cum = np.cumsum(counts)
+        n = int(cum[-1])
+        if n == 0:
+            return None
+        bounds = []
+        for q in (2, 98):
+            # Линейная интерполяция между соседними рангами; значение ранга r - первое, где cum > r
+            rank = q / 100 * (n - 1)
+            low, high = np.searchsorted(cum, [np.floor(rank), np.ceil(rank)], side='right')
+            bounds.append(float(low + (high - low) * (rank - np.floor(rank))))
+        return bounds[0], bounds[1]
+    
+    def _array_stats(self, raw: np.ndarray) -> List[Optional[Tuple[float, float]]]:
+        """Границы 2-98% положительных значений каналов прочитанного растра (CxHxW)"""
+        if self._counted_dtype(raw.dtype):
+            return [self._counts_bounds(self._value_counts(band)) for band in raw]
+        
+        stats = []
+        for band in raw:
+            band = np.nan_to_num(band.astype(np.float32), copy=False, nan=0.0, posinf=255.0, neginf=0.0)
+            positive = band[band > 0]
+            stats.append(tuple(float(v) for v in np.percentile(positive, [2, 98])) if positive.size else None)
+        return stats
+    
+    def _raster_stats(self, src, channels: List[int], content_hash: Optional[str] = None,
+                      raw: Optional[np.ndarray] = None,
+                      strip_pixels: int = 1 << 22) -> List[Optional[Tuple[float, float]]]:
+        """Статистика нормализации по всему растру с кэшированием по файлу
+        
+        raw - уже прочитанные в полном разрешении каналы, если есть. Для
+        целочисленных типов до 16 бит границы точные: гистограмма значений
+        по raw или по полосам файла. Вещественные растры больше
+        STATS_SAMPLE_SIZE оцениваются по прореженному чтению, одинаковому
+        для снимка целиком и для чтения окнами.
+        """
+        from rasterio.windows import Window
+        from rasterio.enums import Resampling
+        
+        key = (content_hash, tuple(channels))
+        if content_hash is not None:
+            stats = self._stats_cache.get(key)
+            if stats is not None:
+                return stats
+        
+        with metrics.stage("stats"):
+            if self._counted_dtype(np.dtype(src.dtypes[channels[0] - 1])):
+                if raw is None:
+                    # Один проход полосами фиксированного объёма с суммированием гистограмм
+                    bands = sorted(set(channels))
+                    counts = {}
+                    strip = max(1, strip_pixels // max(1, src.width))
+                    for row in range(0, src.height, strip):
+                        block = src.read(bands, window=Window(0, row, src.width, min(strip, src.height - row)))
+                        for band, data in zip(bands, block):
+                            band_counts = self._value_counts(data)
+                            counts[band] = counts[band] + band_counts if band in counts else band_counts
+                    stats = [self._counts_bounds(counts[band]) for band in channels]
+                else:
+                    stats = self._array_stats(raw)
+            else:
+                scale = min(1.0, STATS_SAMPLE_SIZE / max(src.width, src.height))
+                if raw is None or scale < 1:
+                    out_shape = (len(channels), max(1, round(src.height * scale)), max(1, round(src.width * scale)))
+                    raw = src.read(channels, out_shape=out_shape, resampling=Resampling.nearest)
+                stats = self._array_stats(raw)
+        
+        if content_hash is not None:
+            self._stats_cache.put(key, stats)
+        return stats
+    
+    def _normalize(self, data: np.ndarray, stats: List[Optional[Tuple[float, float]]]) -> np.ndarray:
+        """Нормализация каналов на месте по заранее вычисленным границам"""
+        for i, channel_stats in enumerate(stats):
+            channel = data[:, :, i]
+            if channel_stats is None:
+                data[:, :, i] = 0
+                continue
+            min_val, max_val = channel_stats
+            # На месте, без временных массивов размером со снимок
+            if max_val > min_val:
+                channel -= min_val
+                channel *= 1 / (max_val - min_val)
+                np.clip(channel, 0, 1, out=channel)
+            else:
+                channel /= 255.0
+        return data
+    
+    def read_raster(self, source: RasterSource, channels_str: Optional[str] = None) -> Tuple[np.ndarray, dict, object, object]:
+        """Чтение выбранных каналов целиком (CxHxW, исходный тип) без нормализации
+        
+        Для пакетной обработки, где чтение и нормализация идут в разных
+        потоках (см. normalize).
+        """
+        with self._open_raster(source) as src:
+            channels = self._select_channels(src, channels_str)
+            return src.read(channels), src.profile.copy(), src.transform, src.crs
+    
+    def normalize(self, raw: np.ndarray) -> np.ndarray:
+        """Нормализация прочитанного растра (CxHxW) по его же границам 2-98%"""
+        return self._normalize(self._as_float(raw), self._array_stats(raw))
+    
+    def process_raster(self, file_bytes: RasterSource, channels_str: Optional[str] = None,
+                       content_hash: Optional[str] = None) -> Tuple[np.ndarray, dict, object, object]:
         """Обработка растра с выбором каналов"""
+        content_hash = content_hash or self.content_hash(file_bytes)
+        if self.cache is None:
+            return self._decode_raster(file_bytes, channels_str, content_hash)
+        return self.cache.get_or_compute(
+            ("raster", content_hash, channels_str),
+            lambda: self._decode_raster(file_bytes, channels_str, content_hash)
+        )
+    
+    def _decode_raster(self, file_bytes: RasterSource, channels_str: Optional[str],
+                       content_hash: str) -> Tuple[np.ndarray, dict, object, object]:
+        """Чтение и нормализация растра без кэша"""
+        import rasterio
+        from PIL import Image
+        
         try:
-            with MemoryFile(file_bytes) as memfile:
-                with memfile.open() as src:
-                    # Сохраняем метаданные
-                    profile, transform, crs = src.profile.copy(), src.transform, src.crs
-                    
-                    # Выбор каналов
-                    if channels_str and src.count > 3:
-                        channels = [min(max(1, int(ch)), src.count) for ch in channels_str.split(',')[:3]]
-                    else:
-                        channels = [1, 2, 3] if src.count >= 3 else [1] * 3
-                    
-                    # Чтение и нормализация данных
-                    data = src.read(channels).transpose(1, 2, 0).astype(np.float32)
-                    data = np.nan_to_num(data, nan=0.0, posinf=255.0, neginf=0.0)
-                    
-                    # Нормализация каналов
-                    for i in range(3):
-                        channel = data[:, :, i]
-                        if np.any(channel > 0):
-                            min_val, max_val = np.percentile(channel[channel > 0], [2, 98])
-                            data[:, :, i] = np.clip((channel - min_val) / (max_val - min_val), 0, 1) if max_val > min_val else channel / 255.0
-                        else:
-                            data[:, :, i] = 0
-                    
-                    return data, profile, transform, crs
+            with self._open_raster(file_bytes) as src:
+                # Сохраняем метаданные
+                profile, transform, crs = src.profile.copy(), src.transform, src.crs
+                
+                # Чтение и нормализация данных
+                channels = self._select_channels(src, channels_str)
+                with metrics.stage("decode"):
+                    raw = src.read(channels)
+                # Статистика по уже прочитанным данным, без повторного чтения файла
+                stats = self._raster_stats(src, channels, content_hash, raw)
+                with metrics.stage("normalize"):
+                    data = self._normalize(self._as_float(raw), stats)
+                
+                return data, profile, transform, crs
         except:
             # Обработка как обычное изображение
-            img = Image.open(io.BytesIO(file_bytes)).convert('RGB')
+            img = Image.open(file_bytes if isinstance(file_bytes, str) else io.BytesIO(file_bytes)).convert('RGB')
             data = np.array(img, dtype=np.float32) / 255.0
             h, w = data.shape[:2]
             
@@ -86,29 +338,56 @@ class EuroSATClassifier:
             
             return data, profile, transform, None
     
-    def create_preview(self, file_bytes: bytes, channels_str: Optional[str] = None) -> bytes:
-        """Создание превью с выбранными каналами"""
-        data, _, _, _ = self.process_raster(file_bytes, channels_str)
+    def create_preview(self, file_bytes: RasterSource, channels_str: Optional[str] = None, max_size: int = 800,
+                       image_format: str = "png") -> bytes:
+        """Создание превью с выбранными каналами
         
-        # Преобразование в изображение
-        img = Image.fromarray((data * 255).astype(np.uint8))
+        Растр читается сразу в размере превью: GDAL берёт подходящий
+        внутренний обзор, а без обзоров читает с прореживанием. Границы
+        нормализации считаются по уменьшенным данным, поэтому время не
+        зависит от размера снимка.
+        """
+        from PIL import Image
         
-        # Ограничение размера
-        max_size = 800
-        if max(img.size) > max_size:
-            ratio = max_size / max(img.size)
-            img = img.resize((int(img.width * ratio), int(img.height * ratio)), Image.Resampling.LANCZOS)
+        try:
+            with self._open_raster(file_bytes) as src:
+                from rasterio.enums import Resampling
+                
+                channels = self._select_channels(src, channels_str)
+                scale = min(1.0, max_size / max(src.width, src.height))
+                out_shape = (3, max(1, round(src.height * scale)), max(1, round(src.width * scale)))
+                # По обзору можно усреднять, по полному разрешению - только прореживать
+                resampling = Resampling.average if src.overviews(channels[0]) else Resampling.nearest
+                data = self.normalize(src.read(channels, out_shape=out_shape, resampling=resampling))
+                img = Image.fromarray((data * 255).astype(np.uint8))
+        except:
+            # Обычное изображение: JPEG декодируется сразу с уменьшением
+            img = Image.open(file_bytes if isinstance(file_bytes, str) else io.BytesIO(file_bytes))
+            img.draft('RGB', (max_size, max_size))
+            img = img.convert('RGB')
+            img.thumbnail((max_size, max_size), Image.Resampling.BILINEAR)
         
-        # Сохранение в байты
+        # Быстрое сжатие вместо optimize=True
         buf = io.BytesIO()
-        img.save(buf, format='PNG', optimize=True)
-        buf.seek(0)
+        if image_format == "jpeg":
+            img.save(buf, format='JPEG', quality=85)
+        elif image_format == "webp":
+            img.save(buf, format='WEBP', quality=80, method=0)
+        else:
+            img.save(buf, format='PNG', compress_level=1)
         return buf.getvalue()
     
-    def classify_fast(self, data: np.ndarray) -> np.ndarray:
-        """Быстрая классификация без перекрытий"""
+    def classify_grid(self, data: np.ndarray, progress: Optional[ProgressCallback] = None,
+                      stride: Optional[int] = None) -> np.ndarray:
+        """Классификация без перекрытий: сетка меток размером в патчах
+        
+        При stride меньше patch_size классификация идёт с перекрытием
+        (см. classify_overlap), и ячейка сетки равна stride пикселей.
+        """
         if self.model is None:
             raise RuntimeError("Модель не загружена")
+        if stride and stride != self.patch_size:
+            return self.classify_overlap(data, stride, progress)
         
         h, w = data.shape[:2]
         
@@ -136,89 +415,376 @@ class EuroSATClassifier:
         
         for i in range(0, n_patches, self.batch_size):
             batch = patches[i:i + self.batch_size]
-            batch_pred = self.model.predict(batch, verbose=0)
+            batch_pred = self.predict_batch(batch)
             predictions[i:i + len(batch)] = np.argmax(batch_pred, axis=1)
+            if progress:
+                progress(i + len(batch), n_patches)
         
         # Восстановление формы
-        class_map = predictions.reshape(n_patches_h, n_patches_w)
-        class_map = np.repeat(np.repeat(class_map, self.patch_size, axis=0), self.patch_size, axis=1)
+        return predictions.reshape(n_patches_h, n_patches_w)
+    
+    def classify_overlap(self, data: np.ndarray, stride: int,
+                         progress: Optional[ProgressCallback] = None) -> np.ndarray:
+        """Классификация скользящим окном с перекрытием
+        
+        Патчи берутся с шагом stride через sliding_window_view без копирования
+        снимка. Вероятности каждого патча с весами по положению ячейки внутри
+        патча суммируются в ячейки stride x stride; каждая ячейка покрыта
+        ровно k x k патчами (k = patch_size / stride).
+        """
+        if stride <= 0 or self.patch_size % stride:
+            raise ValueError("stride должен делить patch_size")
+        
+        ps = self.patch_size
+        k = ps // stride
+        h, w = data.shape[:2]
+        n_cells_h = -(-h // stride)
+        n_cells_w = -(-w // stride)
+        
+        # Поля по краям, чтобы крайние ячейки тоже были покрыты k x k патчами
+        margin = ps - stride
+        data_padded = np.pad(
+            data,
+            ((margin, n_cells_h * stride - h + margin), (margin, n_cells_w * stride - w + margin), (0, 0)),
+            mode='reflect'
+        )
+        
+        # Представление всех патчей без копирования: (n_h, n_w, 3, ps, ps)
+        windows = sliding_window_view(data_padded, (ps, ps), axis=(0, 1))[::stride, ::stride]
+        n_patches_h, n_patches_w = windows.shape[:2]
+        n_patches = n_patches_h * n_patches_w
+        
+        probs = None
+        for i in range(0, n_patches, self.batch_size):
+            idx = np.arange(i, min(i + self.batch_size, n_patches))
+            batch = windows[idx // n_patches_w, idx % n_patches_w].transpose(0, 2, 3, 1)
+            batch_pred = self.predict_batch(np.ascontiguousarray(batch, dtype=np.float32))
+            if probs is None:
+                probs = np.empty((n_patches, batch_pred.shape[1]), dtype=np.float32)
+            probs[i:i + len(batch)] = batch_pred
+            if progress:
+                progress(i + len(batch), n_patches)
+        probs = probs.reshape(n_patches_h, n_patches_w, -1)
+        
+        # Вес ячейки внутри патча: треугольное окно с максимумом в центре
+        tent = 1 - np.abs((np.arange(k) + 0.5) / k - 0.5)
+        weights = np.outer(tent, tent)
+        
+        # Патч (i, j) покрывает ячейки (i..i+k-1, j..j+k-1) расширенной сетки
+        acc = np.zeros((n_patches_h + k - 1, n_patches_w + k - 1, probs.shape[2]), dtype=np.float32)
+        for a in range(k):
+            for b in range(k):
+                acc[a:a + n_patches_h, b:b + n_patches_w] += probs * weights[a, b]
         
-        # Обрезка до оригинального размера
+        # Ячейки снимка начинаются после полей шириной k-1 ячеек
+        acc = acc[k - 1:k - 1 + n_cells_h, k - 1:k - 1 + n_cells_w]
+        return np.argmax(acc, axis=2).astype(np.uint8)
+    
+    def expand_grid(self, grid: np.ndarray, shape: Tuple[int, int], cell_size: Optional[int] = None) -> np.ndarray:
+        """Попиксельная карта классов из сетки с обрезкой до размера снимка"""
+        cell_size = cell_size or self.patch_size
+        h, w = shape
+        class_map = np.repeat(np.repeat(grid, cell_size, axis=0), cell_size, axis=1)
         return class_map[:h, :w]
     
-    def create_visualization(self, class_map: np.ndarray) -> bytes:
-        """Создание RGB визуализации"""
-        h, w = class_map.shape
-        rgb = np.zeros((h, w, 3), dtype=np.uint8)
+    def classify_fast(self, data: np.ndarray, progress: Optional[ProgressCallback] = None) -> np.ndarray:
+        """Быстрая классификация без перекрытий"""
+        return self.expand_grid(self.classify_grid(data, progress), data.shape[:2])
+    
+    def classify_windowed(self, source: RasterSource, output_path: str,
+                          channels_str: Optional[str] = None, window_size: int = 1024) -> str:
+        """Потоковая классификация по окнам с записью в Cloud-Optimized GeoTIFF
+        
+        Растр читается блоками, кратными patch_size, поэтому пиковая память
+        определяется размером окна, а не размером снимка.
+        """
+        import rasterio
+        import rasterio.shutil
+        from rasterio.windows import Window
+        
+        window_size = max(self.patch_size, window_size // self.patch_size * self.patch_size)
+        
+        with self._open_raster(source) as src:
+            channels = self._select_channels(src, channels_str)
+            # Границы нормализации общие для всех окон
+            stats = self._raster_stats(src, channels, self.content_hash(source))
+            
+            out_profile = src.profile.copy()
+            out_profile.update({
+                'driver': 'GTiff', 'count': 1, 'dtype': 'uint8', 'compress': 'lzw',
+                'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'BIGTIFF': 'IF_SAFER'
+            })
+            for key in ('nodata', 'photometric', 'interleave'):
+                out_profile.pop(key, None)
+            
+            # Драйвер COG пишет только копированием - сначала обычный тайловый GeoTIFF
+            tmp_path = output_path + ".tmp.tif"
+            with rasterio.open(tmp_path, 'w', **out_profile) as dst:
+                for row in range(0, src.height, window_size):
+                    for col in range(0, src.width, window_size):
+                        window = Window(col, row, min(window_size, src.width - col), min(window_size, src.height - row))
+                        with metrics.stage("decode"):
+                            data = self._read_channels(src, channels, window=window)
+                        with metrics.stage("normalize"):
+                            data = self._normalize(data, stats)
+                        classes = self.classify_fast(data)
+                        with metrics.stage("write"):
+                            dst.write(classes, 1, window=window)
+                dst.write_colormap(1, {class_id: tuple(color) for class_id, color in self.class_colors.items()})
         
+        try:
+            with metrics.stage("write"):
+                rasterio.shutil.copy(tmp_path, output_path, **COG_OPTIONS)
+        finally:
+            os.remove(tmp_path)
+        return output_path
+    
+    @property
+    def palette(self) -> np.ndarray:
+        """Таблица цветов 256x3 (LUT) из class_colors"""
+        palette = np.zeros((256, 3), dtype=np.uint8)
         for class_id, color in self.class_colors.items():
-            rgb[class_map == class_id] = color
+            palette[class_id] = color
+        return palette
+    
+    def create_visualization(self, class_map: np.ndarray, shape: Optional[Tuple[int, int]] = None,
+                             cell_size: Optional[int] = None) -> bytes:
+        """Создание визуализации - PNG с палитрой классов
+        
+        class_map - сетка меток с ячейками cell_size пикселей (по умолчанию
+        patch_size); увеличение до размера shape выполняется при записи.
+        """
+        from PIL import Image
+        
+        cell_size = cell_size or self.patch_size
+        gh, gw = class_map.shape
+        h, w = shape or (gh * cell_size, gw * cell_size)
+        
+        img = Image.fromarray(class_map.astype(np.uint8), mode='P')
+        img.putpalette(self.palette[:len(self.class_colors)].ravel().tolist())
+        img = img.resize((gw * cell_size, gh * cell_size), Image.Resampling.NEAREST).crop((0, 0, w, h))
         
-        img = Image.fromarray(rgb)
         buf = io.BytesIO()
-        img.save(buf, format='PNG', optimize=True)
+        img.save(buf, format='PNG', compress_level=6)
         buf.seek(0)
         return buf.getvalue()
     
-    def create_geotiff(self, class_map: np.ndarray, profile: dict, transform: object, crs: object) -> bytes:
-        """Создание GeoTIFF"""
+    def create_geotiff(self, class_map: np.ndarray, profile: dict, transform: object, crs: object,
+                       cell_size: Optional[int] = None) -> bytes:
+        """Создание Cloud-Optimized GeoTIFF с разрешением сетки патчей
+        
+        Тайлы 256x256, внутренние обзоры (nearest) и таблица цветов классов.
+        Если размер снимка не кратен cell_size, крайние ячейки выходят за
+        снимок на паддинг; границы самого снимка записываются в тег
+        SCENE_BOUNDS (по ним обрезаются тайлы, см. render_tile).
+        """
+        from rasterio.io import MemoryFile
+        from affine import Affine
+        
+        cell_size = cell_size or self.patch_size
         out_profile = profile.copy()
-        out_profile.update({'count': 1, 'dtype': 'uint8', 'compress': 'lzw'})
-        out_profile.pop('nodata', None)
+        for key in ('nodata', 'photometric', 'interleave', 'tiled', 'blockxsize', 'blockysize'):
+            out_profile.pop(key, None)
+        out_profile.update(COG_OPTIONS)
+        out_profile.update({'count': 1, 'dtype': 'uint8', 'height': class_map.shape[0], 'width': class_map.shape[1]})
+        if transform:
+            # Одна ячейка сетки - патч cell_size x cell_size исходных пикселей
+            out_profile['transform'] = transform * Affine.scale(cell_size)
+        h, w = profile['height'], profile['width']
+        clipped = transform and (h % cell_size or w % cell_size)
+        if crs:
+            out_profile['crs'] = crs
         
         with MemoryFile() as memfile:
             with memfile.open(**out_profile) as dst:
-                dst.write(class_map, 1)
-                if transform: dst.transform = transform
-                if crs: dst.crs = crs
+                dst.write(class_map.astype(np.uint8), 1)
+                # Обзоры строит драйвер COG при закрытии
+                dst.write_colormap(1, {class_id: tuple(color) for class_id, color in self.class_colors.items()})
+                if clipped:
+                    (x0, x1), (y0, y1) = zip(transform * (0, 0), transform * (w, h))
+                    dst.update_tags(SCENE_BOUNDS=f"{min(x0, x1)},{min(y0, y1)},{max(x0, x1)},{max(y0, y1)}")
             return memfile.read()
     
-    def create_geojson(self, class_map: np.ndarray, transform: object, crs: object) -> str:
-        """Создание GeoJSON с упрощением геометрий"""
-        features = []
+    def render_tile(self, source: RasterSource, z: int, x: int, y: int, tile_size: int = 256) -> bytes:
+        """PNG-тайл XYZ (Web Mercator) из GeoTIFF классов
         
-        if transform:
-            # Упрощаем растр перед векторизацией для скорости
-            from scipy.ndimage import median_filter
-            class_map_smooth = median_filter(class_map, size=3)
-            
-            for geom, value in shapes(class_map_smooth.astype(np.int32), transform=transform):
-                if value > 0:
-                    features.append({
-                        "type": "Feature",
-                        "properties": {
-                            "class": int(value),
-                            "class_name": self.class_names.get(int(value), "Unknown")
-                        },
-                        "geometry": geom
-                    })
-        
-        geojson = {"type": "FeatureCollection", "features": features}
+        Через WarpedVRT читается только область тайла; на мелких масштабах
+        GDAL берёт внутренние обзоры COG. Область вне снимка прозрачная,
+        включая паддинг крайних ячеек за SCENE_BOUNDS (как у GeoJSON).
+        """
+        from rasterio.vrt import WarpedVRT
+        from rasterio.enums import Resampling
+        from affine import Affine
+        from PIL import Image
+        
+        size = 2 * WEB_MERCATOR_HALF / 2 ** z
+        left, top = -WEB_MERCATOR_HALF + x * size, WEB_MERCATOR_HALF - y * size
+        tile_transform = Affine(size / tile_size, 0, left, 0, -size / tile_size, top)
+        
+        with self._open_raster(source) as src:
+            if src.crs is None:
+                raise ValueError("Результат без географической привязки")
+            # VRT с сеткой самого тайла: перепроецируется только его область.
+            # Индекс 255 не занят классами - прозрачный фон вне снимка
+            with WarpedVRT(src, crs="EPSG:3857", transform=tile_transform, width=tile_size, height=tile_size,
+                           nodata=255, resampling=Resampling.nearest) as vrt:
+                data = vrt.read(1)
+            scene_bounds = src.tags().get("SCENE_BOUNDS")
+            if scene_bounds:
+                from rasterio.features import geometry_mask
+                from rasterio.warp import transform_geom
+                import shapely
+                from shapely.geometry import box, mapping
+                
+                # Прямоугольник снимка с промежуточными вершинами - в Web Mercator его стороны изгибаются
+                footprint = box(*map(float, scene_bounds.split(",")))
+                footprint = shapely.segmentize(footprint, max(footprint.bounds[2] - footprint.bounds[0],
+                                                              footprint.bounds[3] - footprint.bounds[1]) / 64)
+                footprint = transform_geom(src.crs, "EPSG:3857", mapping(footprint))
+                data[geometry_mask([footprint], data.shape, tile_transform)] = 255
+        
+        img = Image.fromarray(data, mode='P')
+        img.putpalette(self.palette.ravel().tolist())
+        buf = io.BytesIO()
+        img.save(buf, format='PNG', transparency=255, compress_level=1)
+        return buf.getvalue()
+    
+    def vector_features(self, class_map: np.ndarray, transform: object,
+                        cell_size: Optional[int] = None,
+                        shape: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[int, object]]:
+        """Геометрии классов по сетке патчей: по одной (Multi)Polygon на класс
+        
+        shapes() склеивает связные ячейки одного класса, а разные компоненты
+        класса не пересекаются, поэтому объединение по классу - сборка
+        MultiPolygon без union. При simplify > 0 границы упрощаются
+        coverage_simplify, который сохраняет общие границы соседних классов;
+        на shapely без него - simplify с preserve_topology по каждому классу.
+        """
+        from rasterio.features import shapes
+        from affine import Affine
+        import shapely
+        from shapely.geometry import shape as to_shape, Polygon
+        
+        if not transform:
+            return
+        
+        cell_size = cell_size or self.patch_size
+        parts: Dict[int, list] = {}
+        for geom, value in shapes(class_map.astype(np.uint8), transform=transform * Affine.scale(cell_size)):
+            if value > 0:
+                parts.setdefault(int(value), []).append(to_shape(geom))
+        if not parts:
+            return
+        
+        values = sorted(parts)
+        geometries = np.array([shapely.multipolygons(parts[value]) for value in values])
+        
+        # Крайние ячейки выходят за снимок на паддинг - обрезаем по его контуру
+        if shape and (shape[0] % cell_size or shape[1] % cell_size):
+            h, w = shape
+            footprint = Polygon([transform * (0, 0), transform * (w, 0), transform * (w, h), transform * (0, h)])
+            geometries = shapely.intersection(geometries, footprint)
+        
+        if self.simplify > 0:
+            tolerance = self.simplify * abs(transform.a)
+            if hasattr(shapely, "coverage_simplify"):
+                geometries = shapely.coverage_simplify(geometries, tolerance)
+            else:
+                geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+        
+        for value, geom in zip(values, geometries):
+            if not geom.is_empty:
+                yield value, geom
+    
+    def create_geojson(self, class_map: np.ndarray, transform: object, crs: object,
+                       cell_size: Optional[int] = None, shape: Optional[Tuple[int, int]] = None) -> str:
+        """Создание GeoJSON векторизацией сетки патчей
+        
+        Объекты пишутся строками через shapely.to_geojson, без дерева словарей.
+        """
+        import shapely
         
+        header = '{"type": "FeatureCollection", '
         if crs:
             try:
                 epsg = crs.to_epsg()
                 if epsg:
-                    geojson["crs"] = {"type": "name", "properties": {"name": f"EPSG:{epsg}"}}
+                    header += f'"crs": {json.dumps({"type": "name", "properties": {"name": f"EPSG:{epsg}"}})}, '
             except:
                 pass
         
-        return json.dumps(geojson)
+        features = []
+        for value, geom in self.vector_features(class_map, transform, cell_size, shape):
+            properties = json.dumps({"class": value, "class_name": self.class_names.get(value, "Unknown")})
+            features.append(f'{{"type": "Feature", "properties": {properties}, "geometry": {shapely.to_geojson(geom)}}}')
+        return header + '"features": [' + ", ".join(features) + "]}"
     
-    def classify_all(self, file_bytes: bytes, channels_str: Optional[str] = None) -> Dict[str, str]:
-        """Полный пайплайн классификации"""
-        # Обработка и классификация
-        data, profile, transform, crs = self.process_raster(file_bytes, channels_str)
-        class_map = self.classify_fast(data)  # Используем быстрый метод без перекрытий
+    def create_vector(self, class_map: np.ndarray, transform: object, crs: object, driver: str,
+                      cell_size: Optional[int] = None, shape: Optional[Tuple[int, int]] = None) -> bytes:
+        """Векторный результат в двоичном формате GDAL (FlatGeobuf, GPKG)"""
+        import geopandas as gpd
+        
+        features = list(self.vector_features(class_map, transform, cell_size, shape))
+        frame = gpd.GeoDataFrame(
+            {
+                "class": [value for value, _ in features],
+                "class_name": [self.class_names.get(value, "Unknown") for value, _ in features],
+            },
+            geometry=[geom for _, geom in features],
+            crs=crs,
+        )
+        buf = io.BytesIO()
+        frame.to_file(buf, driver=driver, layer="classification")
+        return buf.getvalue()
+    
+    def classify_map(self, file_bytes: RasterSource, channels_str: Optional[str] = None,
+                     content_hash: Optional[str] = None,
+                     progress: Optional[ProgressCallback] = None,
+                     stride: Optional[int] = None) -> Tuple[np.ndarray, dict, object, object, int]:
+        """Сетка меток с метаданными и размером ячейки для построения результатов"""
+        data, profile, transform, crs = self.process_raster(file_bytes, channels_str, content_hash)
+        grid = self.classify_grid(data, progress, stride)  # Без перекрытий, если stride не задан
+        return grid, profile, transform, crs, stride or self.patch_size
+    
+    def render_artifact(self, name: str, class_map: np.ndarray, profile: dict,
+                        transform: object, crs: object, cell_size: Optional[int] = None) -> Union[bytes, str]:
+        """Построение одного результата по готовой сетке меток"""
+        shape = (profile['height'], profile['width'])
+        if name not in ARTIFACTS:
+            raise ValueError(f"Неизвестный результат: {name}")
+        with metrics.stage(name):
+            if name == "visualization":
+                return self.create_visualization(class_map, shape, cell_size)
+            if name == "geotiff":
+                return self.create_geotiff(class_map, profile, transform, crs, cell_size)
+            if name == "geojson":
+                return self.create_geojson(class_map, transform, crs, cell_size, shape)
+            return self.create_vector(class_map, transform, crs, VECTOR_DRIVERS[name], cell_size, shape)
+    
+    def classify_artifacts(self, file_bytes: RasterSource, channels_str: Optional[str] = None,
+                           content_hash: Optional[str] = None,
+                           progress: Optional[ProgressCallback] = None,
+                           outputs: Optional[Iterable[str]] = None,
+                           stride: Optional[int] = None) -> Dict[str, Union[bytes, str]]:
+        """Полный пайплайн классификации с результатами в исходном виде
         
-        # Создание результатов
-        viz_bytes = self.create_visualization(class_map)
-        geotiff_bytes = self.create_geotiff(class_map, profile, transform, crs)
-        geojson_str = self.create_geojson(class_map, transform, crs)
+        Строятся только результаты из outputs (по умолчанию DEFAULT_ARTIFACTS).
+        """
+        class_map = self.classify_map(file_bytes, channels_str, content_hash, progress, stride)
+        return {
+            name: self.render_artifact(name, *class_map)
+            for name in (outputs or DEFAULT_ARTIFACTS)
+        }
+    
+    def classify_all(self, file_bytes: RasterSource, channels_str: Optional[str] = None,
+                     content_hash: Optional[str] = None,
+                     outputs: Optional[Iterable[str]] = None,
+                     stride: Optional[int] = None) -> Dict[str, str]:
+        """Полный пайплайн классификации"""
+        results = self.classify_artifacts(file_bytes, channels_str, content_hash, outputs=outputs, stride=stride)
         
         # Возврат в base64
         return {
-            "visualization": base64.b64encode(viz_bytes).decode('utf-8'),
-            "geotiff": base64.b64encode(geotiff_bytes).decode('utf-8'),
-            "geojson": geojson_str
+            name: value if isinstance(value, str) else base64.b64encode(value).decode('utf-8')
+            for name, value in results.items()
         }
@@ -0,0 +1,259 @@
+# inference_server.py
+"""Отдельный процесс инференса, общий для нескольких HTTP-воркеров
+
+Запуск:
+    python inference_server.py
+    INFERENCE_MODE=remote uvicorn main:app --workers 4
+
+Воркеры передают загрузки через файлы в общей памяти (/dev/shm), а не
+через сокет: сервер открывает их по пути, и GDAL читает их через mmap.
+Модель, кэш декодированных растров и батчер существуют в одном экземпляре.
+
+multiprocessing.connection передаёт сообщения через pickle, поэтому ключ
+аутентификации обязателен. Без INFERENCE_AUTHKEY сервер создаёт случайный
+ключ в RUNTIME_DIR (права 0700), и воркеры на той же машине читают его
+оттуда; для адреса host:port ключ нужно задать явно.
+"""
+import os
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Listener
+from typing import Optional, Union
+
+from classifier import EuroSATClassifier, RasterSource
+from jobs import private_dir
+from metrics import metrics
+
+# Методы классификатора, доступные воркерам
+REMOTE_METHODS = {"check_channels", "create_preview", "classify_map", "classify_windowed"}
+# Файл случайного ключа в RUNTIME_DIR, если INFERENCE_AUTHKEY не задан
+AUTHKEY_FILE = "inference.key"
+
+
+def parse_address(address: str) -> Union[str, tuple]:
+    """Путь Unix-сокета или host:port"""
+    if ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return address
+
+
+def check_authkey(address: str, authkey: Optional[bytes]):
+    """Без явного ключа сервер доступен только через Unix-сокет"""
+    if not authkey and isinstance(parse_address(address), tuple):
+        raise RuntimeError("Для адреса host:port задайте INFERENCE_AUTHKEY")
+
+
+def create_authkey(runtime_dir: str) -> bytes:
+    """Новый случайный ключ в файле RUNTIME_DIR для воркеров на этой машине"""
+    key = secrets.token_hex(32).encode()
+    path = os.path.join(private_dir(runtime_dir), AUTHKEY_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+        f.write(key)
+    os.replace(tmp_path, path)
+    return key
+
+
+def read_authkey(runtime_dir: str) -> bytes:
+    """Ключ, созданный сервером инференса (см. create_authkey)"""
+    with open(os.path.join(runtime_dir, AUTHKEY_FILE), 'rb') as f:
+        return f.read()
+
+
+class InferenceServer:
+    """Сервер, выполняющий вызовы классификатора от HTTP-воркеров
+    
+    Каждое соединение обслуживается своим потоком, поэтому патчи из
+    запросов разных воркеров объединяются общим батчером классификатора.
+    """
+    
+    def __init__(self, classifier: EuroSATClassifier, address: str, authkey: bytes):
+        self.classifier = classifier
+        self.address = parse_address(address)
+        self.authkey = authkey
+    
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)  # Сокет от предыдущего запуска
+        
+        with Listener(self.address, authkey=self.authkey) as listener:
+            if isinstance(self.address, str):
+                os.chmod(self.address, 0o600)
+            print(f"Сервер инференса слушает {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"Отклонено соединение: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+    
+    def _status(self) -> dict:
+        return {
+            "ready": self.classifier.model is not None,
+            "model_version": self.classifier.model_version,
+            "timings": self.classifier.timings,
+        }
+    
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                
+                try:
+                    if method == "status":
+                        result = self._status()
+                    elif method in REMOTE_METHODS:
+                        if kwargs.pop("progress", False):
+                            kwargs["progress"] = lambda done, total: conn.send(("progress", done, total))
+                        result = getattr(self.classifier, method)(*args, **kwargs)
+                    else:
+                        raise ValueError(f"Неизвестный метод: {method}")
+                    conn.send(("result", result))
+                except Exception as e:
+                    conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class RemoteClassifier(EuroSATClassifier):
+    """Классификатор HTTP-воркера, передающий инференс серверу
+    
+    Хэширование и построение PNG/GeoTIFF/GeoJSON по сетке меток выполняются
+    локально в воркере, чтение растров и модель - в процессе сервера.
+    """
+    
+    def __init__(self, model_path: str, address: str, authkey: Optional[bytes],
+                 shared_dir: Optional[str] = None, runtime_dir: Optional[str] = None,
+                 patch_size: int = 64, **kwargs):
+        super().__init__(model_path, patch_size=patch_size, **kwargs)
+        check_authkey(address, authkey)
+        self.address = parse_address(address)
+        # Без явного ключа - ключ сервера из runtime_dir, читается при каждом подключении
+        self.authkey = authkey
+        self.runtime_dir = runtime_dir
+        self.shared_dir = shared_dir
+        self._local = threading.local()
+    
+    def _conn(self):
+        # Соединение не потокобезопасно - своё на каждый поток пула
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            authkey = self.authkey or read_authkey(self.runtime_dir)
+            conn = self._local.conn = Client(self.address, authkey=authkey)
+        return conn
+    
+    def _call(self, method: str, *args, progress=None, **kwargs):
+        conn = self._conn()
+        if progress is not None:
+            kwargs["progress"] = True
+        try:
+            # Этапы внутри сервера инференса видны в его процессе, здесь - время вызова целиком
+            with metrics.stage(f"remote_{method}"):
+                conn.send((method, args, kwargs))
+                while True:
+                    message = conn.recv()
+                    if message[0] == "progress":
+                        progress(message[1], message[2])
+                        continue
+                    break
+        except (EOFError, OSError):
+            self._local.conn = None  # Переподключение при следующем вызове
+            raise
+        if message[0] == "error":
+            raise RuntimeError(message[1])
+        return message[1]
+    
+    @contextmanager
+    def _shared(self, source: RasterSource):
+        """Путь к файлу для сервера; байты пишутся в общую память"""
+        if isinstance(source, str):
+            yield source
+            return
+        fd, path = tempfile.mkstemp(suffix=".upload", dir=self.shared_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(source)
+            yield path
+        finally:
+            os.remove(path)
+    
+    def load_model(self):
+        """Ожидание готовности модели на сервере"""
+        while True:
+            try:
+                status = self._call("status")
+            except (OSError, EOFError):
+                status = {"ready": False}
+            if status["ready"]:
+                break
+            time.sleep(1)
+        self._model_version = status["model_version"]
+        self.timings.update(status["timings"])
+        # Модель находится в процессе сервера инференса
+        self.model = self.address
+    
+    def enable_batching(self, max_latency: float = 0.005):
+        """Батчинг выполняется на сервере"""
+    
+    def check_channels(self, file_bytes: RasterSource) -> int:
+        with self._shared(file_bytes) as path:
+            return self._call("check_channels", path)
+    
+    def create_preview(self, file_bytes: RasterSource, channels_str: Optional[str] = None, max_size: int = 800,
+                       image_format: str = "png") -> bytes:
+        with self._shared(file_bytes) as path:
+            return self._call("create_preview", path, channels_str, max_size, image_format)
+    
+    def classify_map(self, file_bytes: RasterSource, channels_str: Optional[str] = None,
+                     content_hash: Optional[str] = None, progress=None, stride: Optional[int] = None):
+        with self._shared(file_bytes) as path:
+            return self._call("classify_map", path, channels_str, content_hash, progress=progress, stride=stride)
+    
+    def classify_windowed(self, source: RasterSource, output_path: str,
+                          channels_str: Optional[str] = None, window_size: int = 1024) -> str:
+        with self._shared(source) as path:
+            return self._call("classify_windowed", path, output_path, channels_str, window_size)
+
+
+def main():
+    from cache import LRUCache
+    
+    address = os.getenv("INFERENCE_ADDRESS", "/tmp/eurosat-inference.sock")
+    authkey = os.getenv("INFERENCE_AUTHKEY", "").encode() or None
+    check_authkey(address, authkey)
+    if authkey is None:
+        # Тот же каталог, что у воркеров API в режиме remote (RUNTIME_DIR в main.py)
+        shared_dir = os.getenv("SHARED_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+        runtime_dir = os.getenv("RUNTIME_DIR", os.path.join(shared_dir or tempfile.gettempdir(),
+                                                            f"eurosat-{os.getuid()}"))
+        authkey = create_authkey(runtime_dir)
+    
+    classifier = EuroSATClassifier(
+        os.getenv("MODEL_PATH", "models/best_eurosat_model.h5"),
+        patch_size=64,
+        batch_size=int(os.getenv("BATCH_SIZE", "64")),
+        cache=LRUCache(max_bytes=int(os.getenv("CACHE_MAX_MB", "512")) * 1024 * 1024),
+        backend=os.getenv("INFERENCE_BACKEND", "keras"),
+        quantization=os.getenv("INFERENCE_QUANTIZATION") or None,
+        simplify=float(os.getenv("VECTOR_SIMPLIFY", "0")),
+    )
+    server = InferenceServer(classifier, address, authkey)
+    
+    def load():
+        classifier.load_model()
+        classifier.enable_batching(max_latency=float(os.getenv("BATCH_LATENCY_MS", "5")) / 1000)
+        print(f"Модель загружена и прогрета: {classifier.timings}")
+    
+    # Соединения принимаются сразу, готовность сообщается через "status"
+    threading.Thread(target=load, name="model-loader", daemon=True).start()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# jobs.py
+import fcntl
+import glob
+import io
+import json
+import os
+import stat
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def private_dir(path: str) -> str:
+    """Каталог с правами 0700, принадлежащий текущему пользователю
+    
+    Служебные каталоги лежат в общих местах (/tmp, /dev/shm). Каталог,
+    заранее созданный другим пользователем, позволил бы подложить файлы
+    задач, поэтому такой каталог не принимается.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"Каталог {path} принадлежит другому пользователю или доступен другим")
+    return path
+
+
+def _dump_class_map(class_map: tuple) -> Tuple[bytes, bytes]:
+    """Карта классов в .npy и метаданные в JSON - без pickle"""
+    grid, profile, transform, crs, cell_size = class_map
+    buf = io.BytesIO()
+    np.save(buf, grid, allow_pickle=False)
+    meta = {
+        "profile": {key: value for key, value in profile.items() if key not in ("crs", "transform")},
+        "transform": list(transform)[:6] if transform else None,
+        "crs": crs.to_wkt() if crs else None,
+        "cell_size": cell_size,
+    }
+    # Скаляры numpy в профиле (nodata и т.п.) - в обычные числа
+    return buf.getvalue(), json.dumps(meta, default=lambda value: value.item()).encode('utf-8')
+
+
+def _load_class_map(grid_path: str, meta_path: str) -> tuple:
+    from affine import Affine
+    from rasterio.crs import CRS
+    
+    grid = np.load(grid_path, allow_pickle=False)
+    with open(meta_path, 'rb') as f:
+        meta = json.load(f)
+    transform = Affine(*meta["transform"]) if meta["transform"] else None
+    crs = CRS.from_wkt(meta["crs"]) if meta["crs"] else None
+    profile = dict(meta["profile"], transform=transform, crs=crs)
+    return grid, profile, transform, crs, meta["cell_size"]
+
+
+class Job:
+    """Фоновая задача классификации с прогрессом
+    
+    С storage_dir состояние, результаты и карта классов сохраняются в файлы,
+    чтобы задачу видели все HTTP-воркеры, а не только принявший её.
+    Результаты тогда отдаются из файлов и в памяти не держатся.
+    """
+    
+    # Минимальный интервал записи прогресса на диск, секунды
+    SAVE_INTERVAL = 0.5
+    
+    def __init__(self, storage_dir: Optional[str] = None, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.storage_dir = storage_dir
+        self.status = "queued"  # queued -> running -> done | error
+        self.done = 0
+        self.total = 0
+        # Построенные результаты; значения в results - только без storage_dir
+        self.artifacts: List[str] = []
+        self.results: Dict[str, Any] = {}
+        # Карта классов с метаданными для построения результатов по запросу
+        self.class_map: Optional[tuple] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self._saved = 0.0
+    
+    def _path(self, suffix: str) -> str:
+        return os.path.join(self.storage_dir, f"{self.id}.{suffix}")
+    
+    def _write(self, suffix: str, data: bytes):
+        # Запись через временный файл, чтобы читатели не видели половину;
+        # имя уникально - один файл могут писать несколько воркеров сразу
+        tmp_path = self._path(f"{suffix}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(suffix))
+    
+    @contextmanager
+    def _locked(self):
+        """Блокировка состояния задачи между воркерами
+        
+        Файл состояния заменяется через os.replace, поэтому flock берётся
+        на отдельном <id>.lock, а не на самом <id>.json.
+        """
+        with open(self._path("lock"), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+    
+    def _read_state(self) -> Optional[dict]:
+        try:
+            with open(self._path("json"), 'rb') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def save(self):
+        """Сохранение состояния в storage_dir (если задан)
+        
+        Результаты, добавленные другими воркерами после загрузки задачи,
+        перечитываются под блокировкой и объединяются со своими.
+        """
+        if self.storage_dir is None:
+            return
+        with self._locked():
+            stored = self._read_state()
+            if stored is not None:
+                self.artifacts += [name for name in stored["artifacts"] if name not in self.artifacts]
+            state = {
+                "status": self.status, "done": self.done, "total": self.total,
+                "artifacts": self.artifacts, "error": self.error,
+                "created": self.created, "finished": self.finished,
+            }
+            self._write("json", json.dumps(state).encode('utf-8'))
+        self._saved = time.time()
+    
+    @classmethod
+    def load(cls, storage_dir: str, job_id: str) -> Optional["Job"]:
+        """Состояние задачи другого воркера; результаты и карта классов читаются по запросу"""
+        job = cls(storage_dir, job_id)
+        state = job._read_state()
+        if state is None:
+            return None
+        
+        for key in ("status", "done", "total", "artifacts", "error", "created", "finished"):
+            setattr(job, key, state[key])
+        return job
+    
+    def get_class_map(self) -> Optional[tuple]:
+        """Карта классов из памяти или из файлов задачи"""
+        if self.class_map is None and self.storage_dir is not None and os.path.exists(self._path("map.json")):
+            self.class_map = _load_class_map(self._path("map.npy"), self._path("map.json"))
+        return self.class_map
+    
+    def _store(self, name: str, value: Any):
+        if self.storage_dir is None:
+            self.results[name] = value
+        else:
+            self._write(name, value.encode('utf-8') if isinstance(value, str) else value)
+        if name not in self.artifacts:
+            self.artifacts.append(name)
+    
+    def add_result(self, name: str, value: Any):
+        """Добавление результата, построенного после завершения задачи"""
+        self._store(name, value)
+        self.save()
+    
+    def progress(self, done: int, total: int):
+        """Обновление прогресса (вызывается из потока классификации)"""
+        self.status = "running"
+        self.done, self.total = done, total
+        if time.time() - self._saved > self.SAVE_INTERVAL:
+            self.save()
+    
+    def finish(self, results: Dict[str, Any]):
+        for name, value in results.items():
+            self._store(name, value)
+        self.done = self.total = max(self.total, 1)
+        if self.storage_dir is not None and self.class_map is not None:
+            grid, meta = _dump_class_map(self.class_map)
+            self._write("map.npy", grid)
+            self._write("map.json", meta)
+        self.status = "done"
+        self.finished = time.time()
+        self.save()
+    
+    def fail(self, error: str):
+        self.error = error
+        self.status = "error"
+        self.finished = time.time()
+        self.save()
+    
+    def artifact_path(self, name: str) -> Optional[str]:
+        """Файл результата, если задача хранится на диске"""
+        if self.storage_dir is None or name not in self.artifacts:
+            return None
+        return self._path(name)
+    
+    def remove_files(self):
+        if self.storage_dir is not None:
+            for path in glob.glob(self._path("*")):
+                os.remove(path)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Состояние задачи для ответа API"""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "progress": self.done / self.total if self.total else 0.0,
+            "artifacts": sorted(self.artifacts),
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Хранилище задач с удалением завершённых по истечении ttl
+    
+    storage_dir - каталог файлов задач: результаты отдаются по Range-запросам,
+    и задачи видны всем воркерам. Каталог создаётся с правами 0700.
+    """
+    
+    def __init__(self, ttl: float = 3600, max_jobs: int = 100, storage_dir: Optional[str] = None):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.storage_dir = storage_dir
+        if storage_dir is not None:
+            private_dir(storage_dir)
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+    
+    def create(self) -> Job:
+        """Создание новой задачи"""
+        job = Job(self.storage_dir)
+        job.save()
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+        return job
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.storage_dir is not None and job_id.isalnum():
+            job = Job.load(self.storage_dir, job_id)
+        return job
+    
+    def _evict(self):
+        """Удаление устаревших и самых старых завершённых задач"""
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self.ttl:
+                job.remove_files()
+                del self._jobs[job_id]
+        
+        finished = sorted((j for j in self._jobs.values() if j.finished is not None), key=lambda j: j.finished)
+        while len(self._jobs) >= self.max_jobs and finished:
+            job = finished.pop(0)
+            job.remove_files()
+            del self._jobs[job.id]
@@ -1,11 +1,69 @@
 # main.py
-from fastapi import FastAPI, File, UploadFile, Query
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from classifier import EuroSATClassifier
+from inference_server import RemoteClassifier
+from cache import LRUCache
+from workers import InferencePool, PoolBusyError
+from jobs import JobManager, private_dir
+from metrics import metrics, track_request, enable_profiler
+from python_multipart.multipart import MultipartParser, parse_options_header
+import asyncio
 import base64
+import os
+from contextlib import asynccontextmanager
+import tempfile
+import threading
+import time
+import uuid
+
+# Время начала запуска процесса для разбивки времени старта
+PROCESS_START = time.perf_counter()
 
 MODEL_PATH = "models/best_eurosat_model.h5"
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "512"))
+POOL_WORKERS = int(os.getenv("POOL_WORKERS", "1"))
+POOL_QUEUE = int(os.getenv("POOL_QUEUE", "8"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "64"))
+BATCH_LATENCY_MS = float(os.getenv("BATCH_LATENCY_MS", "5"))
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "keras")
+INFERENCE_QUANTIZATION = os.getenv("INFERENCE_QUANTIZATION") or None
+# local - модель в каждом воркере, remote - общий сервер инференса (inference_server.py)
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "local")
+INFERENCE_ADDRESS = os.getenv("INFERENCE_ADDRESS", "/tmp/eurosat-inference.sock")
+# Без ключа - случайный ключ сервера инференса из RUNTIME_DIR (только Unix-сокет)
+INFERENCE_AUTHKEY = os.getenv("INFERENCE_AUTHKEY", "").encode() or None
+SHARED_DIR = os.getenv("SHARED_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "500"))
+# Допуск упрощения векторных результатов в пикселях снимка (0 - без упрощения)
+VECTOR_SIMPLIFY = float(os.getenv("VECTOR_SIMPLIFY", "0"))
+# Профилирование запросов дольше порога (0 - выключено)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "eurosat-profiles"))
+# В режиме remote загрузки должны быть доступны серверу инференса
+UPLOAD_DIR = SHARED_DIR if INFERENCE_MODE == "remote" else None
+# Служебные файлы (задачи, ключ сервера инференса) - в каталоге с правами 0700;
+# в режиме remote он общий с сервером инференса
+RUNTIME_DIR = os.getenv("RUNTIME_DIR", os.path.join(
+    (SHARED_DIR or tempfile.gettempdir()) if INFERENCE_MODE == "remote" else tempfile.gettempdir(),
+    f"eurosat-{os.getuid()}"
+))
+
+# Типы содержимого результатов классификации
+ARTIFACT_TYPES = {
+    "visualization": "image/png",
+    "geotiff": "image/tiff",
+    "geojson": "application/geo+json",
+    "flatgeobuf": "application/flatgeobuf",
+    "gpkg": "application/geopackage+sqlite3",
+}
+# Результаты, если outputs не указан
+DEFAULT_OUTPUTS = ["visualization", "geotiff", "geojson"]
+# Размер куска при потоковой отдаче и записи загрузок
+STREAM_CHUNK = 1 << 20
 
 app = FastAPI()
 app.add_middleware(
@@ -17,64 +75,579 @@ app.add_middleware(
 
 # Глобальный классификатор
 classifier = None
+# Кэш результатов по (хэш файла, каналы, версия модели)
+cache = LRUCache(max_bytes=CACHE_MAX_MB * 1024 * 1024)
+# Пул для блокирующей работы, общий для всех эндпоинтов
+pool = InferencePool(max_workers=POOL_WORKERS, max_queue=POOL_QUEUE)
+# Ошибка фоновой загрузки модели
+model_error = None
+# Фоновые задачи классификации
+jobs = JobManager(ttl=JOB_TTL, storage_dir=os.path.join(private_dir(RUNTIME_DIR), "jobs"))
+_job_tasks = set()
+
+class UploadError(Exception):
+    """Некорректная загрузка; status_code - код ответа"""
+    status_code = 400
+
+class UploadTooLargeError(UploadError):
+    status_code = 413
+    
+    def __init__(self):
+        super().__init__(f"Файл больше {MAX_UPLOAD_MB} МБ")
+
+def upload_error_response(e: UploadError) -> JSONResponse:
+    """Ответ на некорректную или слишком большую загрузку"""
+    return JSONResponse({"error": str(e), "status": "error"}, status_code=e.status_code)
+
+# Тело запроса для /docs: файл читается из потока запроса (spool_upload), а не через File(...)
+UPLOAD_BODY = {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object", "required": ["file"],
+    "properties": {"file": {"type": "string", "format": "binary"}},
+}}}}}
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Отклонение слишком больших загрузок по Content-Length до чтения тела"""
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_UPLOAD_MB * 1024 * 1024:
+        return upload_error_response(UploadTooLargeError())
+    return await call_next(request)
+
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    """Server-Timing по этапам запроса, счётчики запросов и отданных байтов"""
+    with track_request(request.url.path) as timings:
+        response = await call_next(request)
+    
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.inc("http_requests_total", path=path, status=response.status_code)
+    metrics.observe("http_request_duration_seconds", timings.duration, path=path)
+    response.headers["Server-Timing"] = timings.server_timing()
+    
+    body = response.body_iterator
+    
+    async def counted():
+        async for chunk in body:
+            metrics.inc("response_bytes_total", len(chunk))
+            yield chunk
+    
+    response.body_iterator = counted()
+    return response
+
+async def spool_upload(request: Request) -> str:
+    """Запись поля file из multipart-тела во временный файл, путь к файлу
+    
+    Тело разбирается по мере получения из request.stream(), и файл сразу
+    пишется во временный файл (в SHARED_DIR в режиме remote) - без копии
+    Starlette. Размер проверяется на каждом куске, поэтому загрузка без
+    Content-Length (chunked) обрывается, как только превысит MAX_UPLOAD_MB.
+    Удаление файла - на вызывающем.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Ожидается multipart/form-data с полем file")
+    
+    fd, path = tempfile.mkstemp(suffix=".upload", dir=UPLOAD_DIR)
+    part = {"header": b"", "value": b"", "name": None}
+    found = []
+    
+    def on_header_field(data: bytes, start: int, end: int):
+        part["header"] += data[start:end]
+    
+    def on_header_value(data: bytes, start: int, end: int):
+        part["value"] += data[start:end]
+    
+    def on_header_end():
+        if part["header"].lower() == b"content-disposition":
+            part["name"] = parse_options_header(part["value"])[1].get(b"name")
+        part["header"] = part["value"] = b""
+    
+    def on_part_begin():
+        part["name"] = None
+    
+    def on_headers_finished():
+        if part["name"] == b"file":
+            found.append(True)
+    
+    def on_part_data(data: bytes, start: int, end: int):
+        # Пишется только первое поле file
+        if part["name"] == b"file" and len(found) == 1:
+            f.write(data[start:end])
+    
+    def on_part_end():
+        part["name"] = None
+    
+    size = 0
+    try:
+        with metrics.stage("upload"), os.fdopen(fd, 'wb') as f:
+            parser = MultipartParser(params[b"boundary"], {
+                "on_part_begin": on_part_begin, "on_part_data": on_part_data, "on_part_end": on_part_end,
+                "on_header_field": on_header_field, "on_header_value": on_header_value,
+                "on_header_end": on_header_end, "on_headers_finished": on_headers_finished,
+            })
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_UPLOAD_MB * 1024 * 1024:
+                    raise UploadTooLargeError()
+                parser.write(chunk)
+            parser.finalize()
+        if not found:
+            raise UploadError("Поле file не передано")
+    except BaseException:
+        os.remove(path)
+        raise
+    metrics.inc("upload_bytes_total", size)
+    return path
+
+@asynccontextmanager
+async def spooled(request: Request):
+    """Путь к загрузке на время обработки запроса"""
+    path = await spool_upload(request)
+    try:
+        yield path
+    finally:
+        os.remove(path)
+
+def busy_response(e: PoolBusyError) -> JSONResponse:
+    """Ответ при переполненной очереди пула"""
+    return JSONResponse(
+        {"error": str(e), "status": "busy"}, 
+        status_code=503, 
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def classify_cached(source: str, channels: str, outputs: list, progress=None, job=None, stride=None) -> dict:
+    """Запрошенные результаты классификации из кэша или пайплайна
+    
+    Каждый результат кэшируется отдельно; недостающие строятся по карте
+    классов, которая тоже хранится в кэше (и в задаче, если передана).
+    """
+    content_hash = classifier.content_hash(source)
+    key = (content_hash, channels, stride, classifier.model_version)
+    class_map = []
+    
+    def load_map():
+        if not class_map:
+            class_map.append(cache.get_or_compute(
+                ("class_map",) + key,
+                lambda: classifier.classify_map(source, channels, content_hash, progress, stride)
+            ))
+        return class_map[0]
+    
+    results = {
+        name: cache.get_or_compute(
+            ("artifact", name) + key,
+            lambda: classifier.render_artifact(name, *load_map())
+        )
+        for name in outputs
+    }
+    if job is not None:
+        job.class_map = load_map()
+    return results
 
 @app.on_event("startup")
 async def startup():
     """Инициализация при запуске"""
     global classifier
-    classifier = EuroSATClassifier(MODEL_PATH, patch_size=64, batch_size=4)
-    classifier.load_model()
-    print("Модель загружена и прогрета")
+    if INFERENCE_MODE == "remote":
+        classifier = RemoteClassifier(MODEL_PATH, INFERENCE_ADDRESS, INFERENCE_AUTHKEY, SHARED_DIR,
+                                      runtime_dir=RUNTIME_DIR, cache=cache, simplify=VECTOR_SIMPLIFY)
+    else:
+        classifier = EuroSATClassifier(
+            MODEL_PATH, patch_size=64, batch_size=BATCH_SIZE, cache=cache,
+            backend=INFERENCE_BACKEND, quantization=INFERENCE_QUANTIZATION, simplify=VECTOR_SIMPLIFY
+        )
+    classifier.timings["server_start"] = time.perf_counter() - PROCESS_START
+    if SLOW_REQUEST_MS > 0:
+        enable_profiler(SLOW_REQUEST_MS / 1000, output_dir=PROFILE_DIR)
+    # Модель загружается в фоне, сервер сразу принимает запросы
+    threading.Thread(target=load_model_background, name="model-loader", daemon=True).start()
+
+def load_model_background():
+    """Загрузка и прогрев модели без блокировки старта"""
+    global model_error
+    try:
+        classifier.load_model()
+        # С одним потоком пула в работе один запрос - объединять нечего, батчер дал бы только задержку
+        if POOL_WORKERS > 1:
+            classifier.enable_batching(max_latency=BATCH_LATENCY_MS / 1000)
+        classifier.timings["ready"] = time.perf_counter() - PROCESS_START
+        print(f"Модель загружена и прогрета: {classifier.timings}")
+    except Exception as e:
+        model_error = str(e)
+        print(f"Ошибка загрузки модели: {model_error}")
+
+def model_ready() -> bool:
+    return classifier is not None and classifier.model is not None
 
-@app.post("/check_channels/")
-async def check_channels(file: UploadFile = File(...)):
+def not_ready_response() -> JSONResponse:
+    """Ответ, пока модель загружается"""
+    return JSONResponse(
+        {"error": model_error or "Модель загружается", "status": "loading"}, 
+        status_code=503, 
+        headers={"Retry-After": "5"}
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Остановка пула"""
+    pool.shutdown()
+    if classifier and classifier.batcher:
+        classifier.batcher.close()
+
+@app.post("/check_channels/", openapi_extra=UPLOAD_BODY)
+async def check_channels(request: Request):
     """Проверка количества каналов"""
-    contents = await file.read()
-    channels = classifier.check_channels(contents)
+    def work(path):
+        content_hash = classifier.content_hash(path)
+        return cache.get_or_compute(
+            ("channels", content_hash),
+            lambda: classifier.check_channels(path)
+        )
+    
+    try:
+        async with spooled(request) as path:
+            channels = await pool.run(work, path)
+    except PoolBusyError as e:
+        return busy_response(e)
+    except UploadError as e:
+        return upload_error_response(e)
     return JSONResponse({"channels": channels})
 
-@app.post("/get_preview/")
+@app.post("/get_preview/", openapi_extra=UPLOAD_BODY)
 async def get_preview(
-    file: UploadFile = File(...), 
-    channels: str = Query(None, description="Каналы через запятую")
+    request: Request, 
+    channels: str = Query(None, description="Каналы через запятую"),
+    format: str = Query("png", pattern="^(png|jpeg|webp)$", description="Формат превью"),
+    size: int = Query(800, ge=64, le=2048, description="Размер большей стороны в пикселях")
 ):
     """Получение превью с выбранными каналами"""
-    contents = await file.read()
+    def preview(path):
+        with metrics.stage("preview"):
+            return classifier.create_preview(path, channels, size, format)
+    
+    def work(path):
+        content_hash = classifier.content_hash(path)
+        return cache.get_or_compute(
+            ("preview", content_hash, channels, format, size),
+            lambda: preview(path)
+        )
     
     try:
-        preview_bytes = classifier.create_preview(contents, channels)
+        async with spooled(request) as path:
+            preview_bytes = await pool.run(work, path)
         preview_base64 = base64.b64encode(preview_bytes).decode('utf-8')
-        return JSONResponse({"preview": preview_base64, "status": "success"})
+        return JSONResponse({"preview": preview_base64, "format": format, "status": "success"})
+    except PoolBusyError as e:
+        return busy_response(e)
+    except UploadError as e:
+        return upload_error_response(e)
     except Exception as e:
         return JSONResponse(
             {"error": f"Ошибка создания превью: {str(e)}", "status": "error"}, 
             status_code=500
         )
 
-@app.post("/classify_all/")
+@app.post("/classify_all/", openapi_extra=UPLOAD_BODY)
 async def classify_all(
-    file: UploadFile = File(...), 
-    channels: str = Query(None, description="Каналы через запятую")
+    request: Request, 
+    channels: str = Query(None, description="Каналы через запятую"),
+    format: str = Query("json", pattern="^(json|multipart)$", description="json (base64) или multipart (сырые байты)"),
+    outputs: str = Query(None, description="Результаты через запятую: visualization,geotiff,geojson,flatgeobuf,gpkg"),
+    stride: int = Query(None, ge=8, le=64, description="Шаг окна в пикселях; меньше 64 - классификация с перекрытием")
 ):
     """Классификация изображения"""
-    contents = await file.read()
+    if not model_ready():
+        return not_ready_response()
+    try:
+        names = parse_outputs(outputs)
+        check_stride(stride)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    def work(path):
+        results = classify_cached(path, channels, names, stride=stride)
+        if format == "multipart":
+            return results
+        with metrics.stage("encode"):
+            return {
+                name: value if isinstance(value, str) else base64.b64encode(value).decode('utf-8')
+                for name, value in results.items()
+            }
+    
+    try:
+        async with spooled(request) as path:
+            results = await pool.run(work, path)
+        if format == "multipart":
+            boundary = uuid.uuid4().hex
+            return StreamingResponse(
+                iter_multipart(results, names, boundary),
+                media_type=f"multipart/mixed; boundary={boundary}"
+            )
+        with metrics.stage("encode"):
+            return JSONResponse(results)
+    except PoolBusyError as e:
+        return busy_response(e)
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        return JSONResponse(
+            {"error": f"Ошибка классификации: {str(e)}"}, 
+            status_code=500
+        )
+
+def iter_chunks(data):
+    """Отдача bytes/str кусками без лишних копий"""
+    view = memoryview(data.encode('utf-8') if isinstance(data, str) else data)
+    for offset in range(0, len(view), STREAM_CHUNK):
+        yield view[offset:offset + STREAM_CHUNK]
+
+def iter_multipart(results: dict, names: list, boundary: str):
+    """Тело multipart/mixed с отдельной частью на каждый результат"""
+    for name in names:
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {ARTIFACT_TYPES[name]}\r\n"
+            f"Content-Disposition: attachment; name=\"{name}\"\r\n\r\n"
+        ).encode('utf-8')
+        yield from iter_chunks(results[name])
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode('utf-8')
+
+def parse_outputs(outputs: str) -> list:
+    """Список запрошенных результатов (по умолчанию DEFAULT_OUTPUTS)"""
+    if not outputs:
+        return list(DEFAULT_OUTPUTS)
+    names = [name.strip() for name in outputs.split(',') if name.strip()]
+    unknown = [name for name in names if name not in ARTIFACT_TYPES]
+    if unknown:
+        raise ValueError(f"Неизвестные результаты: {', '.join(unknown)}")
+    return names
+
+def check_stride(stride: int):
+    """Шаг окна должен делить размер патча, иначе сетка ячеек не строится"""
+    if stride is not None and classifier.patch_size % stride:
+        raise ValueError(f"stride должен быть делителем размера патча {classifier.patch_size}")
+
+@app.post("/classify/{artifact}", openapi_extra=UPLOAD_BODY)
+async def classify_artifact(
+    artifact: str,
+    request: Request, 
+    channels: str = Query(None, description="Каналы через запятую"),
+    stride: int = Query(None, ge=8, le=64, description="Шаг окна в пикселях; меньше 64 - классификация с перекрытием")
+):
+    """Классификация с потоковой отдачей одного результата без base64"""
+    if not model_ready():
+        return not_ready_response()
+    if artifact not in ARTIFACT_TYPES:
+        return JSONResponse({"error": "Результат не найден"}, status_code=404)
+    try:
+        check_stride(stride)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        async with spooled(request) as path:
+            results = await pool.run(classify_cached, path, channels, [artifact], stride=stride)
+    except PoolBusyError as e:
+        return busy_response(e)
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        return JSONResponse(
+            {"error": f"Ошибка классификации: {str(e)}"}, 
+            status_code=500
+        )
+    return StreamingResponse(iter_chunks(results[artifact]), media_type=ARTIFACT_TYPES[artifact])
+
+async def run_job(job, path: str, channels: str, outputs: list, stride: int = None):
+    """Выполнение задачи классификации в пуле"""
+    try:
+        job.finish(await pool.run(classify_cached, path, channels, outputs, job.progress, job, stride))
+    except Exception as e:
+        job.fail(f"Ошибка классификации: {str(e)}")
+    finally:
+        os.remove(path)
+
+@app.post("/jobs/", openapi_extra=UPLOAD_BODY)
+async def submit_job(
+    request: Request, 
+    channels: str = Query(None, description="Каналы через запятую"),
+    outputs: str = Query(None, description="Результаты через запятую: visualization,geotiff,geojson,flatgeobuf,gpkg"),
+    stride: int = Query(None, ge=8, le=64, description="Шаг окна в пикселях; меньше 64 - классификация с перекрытием")
+):
+    """Постановка классификации в очередь"""
+    if not model_ready():
+        return not_ready_response()
+    try:
+        names = parse_outputs(outputs)
+        check_stride(stride)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if pool.full:
+        return busy_response(PoolBusyError(pool.retry_after()))
+    
+    try:
+        path = await spool_upload(request)
+    except UploadError as e:
+        return upload_error_response(e)
+    job = jobs.create()
+    task = asyncio.create_task(run_job(job, path, channels, names, stride))
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+    return JSONResponse(job.to_dict(), status_code=202)
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Состояние и прогресс задачи"""
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "Задача не найдена"}, status_code=404)
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/{artifact}")
+async def job_artifact(job_id: str, artifact: str):
+    """Скачивание одного результата задачи"""
+    job = jobs.get(job_id)
+    if job is None or artifact not in ARTIFACT_TYPES:
+        return JSONResponse({"error": "Результат не найден"}, status_code=404)
+    if job.status != "done":
+        return JSONResponse({"error": "Задача не завершена", "status": job.status}, status_code=409)
+    
+    try:
+        await ensure_job_result(job, artifact)
+    except PoolBusyError as e:
+        return busy_response(e)
+    
+    # Из файла - с поддержкой Range (COG читается клиентами по частям)
+    path = job.artifact_path(artifact)
+    if path is not None:
+        return FileResponse(path, media_type=ARTIFACT_TYPES[artifact])
+    return Response(job.results[artifact], media_type=ARTIFACT_TYPES[artifact])
+
+async def ensure_job_result(job, artifact: str):
+    """Построение результата, не запрошенного при постановке, по карте классов задачи"""
+    if artifact not in job.artifacts:
+        # Карта классов задачи другого воркера читается с диска - тоже в пуле
+        job.add_result(artifact, await pool.run(lambda: classifier.render_artifact(artifact, *job.get_class_map())))
+
+@app.get("/jobs/{job_id}/tiles/{z}/{x}/{y}.png")
+async def job_tile(job_id: str, z: int, x: int, y: int):
+    """XYZ-тайл карты классов в Web Mercator для просмотра без скачивания GeoTIFF"""
+    job = jobs.get(job_id)
+    if job is None or not (0 <= z <= 24 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return JSONResponse({"error": "Тайл не найден"}, status_code=404)
+    if job.status != "done":
+        return JSONResponse({"error": "Задача не завершена", "status": job.status}, status_code=409)
+    
+    def work(source):
+        def render():
+            with metrics.stage("tile"):
+                return classifier.render_tile(source, z, x, y)
+        return cache.get_or_compute(("tile", job_id, z, x, y), render)
+    
+    try:
+        await ensure_job_result(job, "geotiff")
+        tile = await pool.run(work, job.artifact_path("geotiff") or job.results["geotiff"])
+    except PoolBusyError as e:
+        return busy_response(e)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    # Результат задачи не меняется - тайлы можно кэшировать на клиенте
+    return Response(tile, media_type="image/png", headers={"Cache-Control": "public, max-age=86400"})
+
+@app.post("/classify_geotiff/", openapi_extra=UPLOAD_BODY)
+async def classify_geotiff(
+    request: Request, 
+    channels: str = Query(None, description="Каналы через запятую"),
+    window_size: int = Query(1024, ge=64, description="Размер окна чтения в пикселях")
+):
+    """Потоковая классификация больших растров в GeoTIFF"""
+    if not model_ready():
+        return not_ready_response()
+    fd, output_path = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
     
     try:
-        results = classifier.classify_all(contents, channels)
-        return JSONResponse(results)
+        async with spooled(request) as path:
+            await pool.run(classifier.classify_windowed, path, output_path, channels, window_size)
+    except PoolBusyError as e:
+        os.remove(output_path)
+        return busy_response(e)
+    except UploadError as e:
+        os.remove(output_path)
+        return upload_error_response(e)
     except Exception as e:
+        os.remove(output_path)
         return JSONResponse(
             {"error": f"Ошибка классификации: {str(e)}"}, 
             status_code=500
         )
+    
+    return FileResponse(
+        output_path, 
+        media_type="image/tiff", 
+        filename="classification.tif",
+        background=BackgroundTask(os.remove, output_path)
+    )
 
 @app.get("/health")
 async def health_check():
-    """Проверка состояния"""
+    """Проверка состояния (liveness): процесс жив и отвечает"""
     return {
         "status": "ok",
-        "model_loaded": classifier is not None and classifier.model is not None
+        "model_loaded": model_ready()
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """Готовность к классификации (readiness) и разбивка времени старта"""
+    timings = classifier.timings if classifier else {}
+    if not model_ready():
+        return JSONResponse(
+            {"ready": False, "error": model_error, "timings": timings}, 
+            status_code=503
+        )
+    return {"ready": True, "timings": timings}
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """Счётчики кэша результатов"""
+    return cache.stats()
+
+@app.get("/pool_stats")
+async def pool_stats():
+    """Глубина очереди и время ожидания пула"""
+    stats = pool.stats()
+    if classifier and classifier.batcher:
+        stats["batcher"] = classifier.batcher.stats()
+    return stats
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    cache_stats = cache.stats()
+    pool_stats = pool.stats()
+    counters = {
+        "cache_hits_total": cache_stats["hits"],
+        "cache_misses_total": cache_stats["misses"],
+        "cache_evictions_total": cache_stats["evictions"],
+        "pool_completed_total": pool_stats["completed"],
+        "pool_rejected_total": pool_stats["rejected"],
+    }
+    gauges = {
+        "cache_items": cache_stats["items"],
+        "cache_bytes": cache_stats["bytes"],
+        "pool_running": pool_stats["running"],
+        "pool_queue_depth": pool_stats["queue_depth"],
+        "pool_wait_max_seconds": pool_stats["wait_max"],
+        "model_ready": int(model_ready()),
+        "uptime_seconds": time.perf_counter() - PROCESS_START,
     }
+    if classifier and classifier.batcher:
+        batcher_stats = classifier.batcher.stats()
+        counters["batches_total"] = batcher_stats["batches"]
+        counters["batched_patches_total"] = batcher_stats["patches"]
+    return Response(metrics.render(counters, gauges), media_type="text/plain; version=0.0.4")
 
 @app.get("/classes")
 async def get_classes():
@@ -0,0 +1,253 @@
+# metrics.py
+"""Таймеры этапов, счётчики и профилирование медленных запросов
+
+Этапы классификатора оборачиваются в metrics.stage(name): время попадает в
+гистограмму для /metrics и, если этап выполняется в рамках HTTP-запроса,
+в заголовок Server-Timing этого запроса. Запрос передаётся в потоки пула
+через contextvars (см. InferencePool.run).
+"""
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+
+class RequestTimings:
+    """Время этапов одного запроса и потоки, в которых он выполняется"""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.stages: Dict[str, float] = {}
+        self.threads = set()
+        # Свёрнутые стеки профайлера: "файл:функция;..." -> число сэмплов
+        self.samples: Counter = Counter()
+        self._lock = threading.Lock()
+    
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+    
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+    
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing (миллисекунды)"""
+        with self._lock:
+            parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.duration * 1000:.1f}")
+        return ", ".join(parts)
+
+
+# Запрос, в рамках которого выполняется текущий код
+_current_request: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Счётчики и гистограммы длительностей в формате Prometheus"""
+    
+    # Границы гистограмм, секунды
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self, prefix: str = "eurosat"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        # (имя, метки) -> [число по границам..., count, sum]
+        self._histograms: Dict[Tuple[str, tuple], list] = {}
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """Увеличение счётчика"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        """Добавление длительности в гистограмму"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * len(self.BUCKETS) + [0, 0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += seconds
+    
+    def record(self, stage: str, seconds: float):
+        """Время этапа в гистограмму и в Server-Timing текущего запроса"""
+        self.observe("stage_duration_seconds", seconds, stage=stage)
+        request = _current_request.get()
+        if request is not None:
+            request.add(stage, seconds)
+    
+    @contextmanager
+    def stage(self, name: str):
+        """Замер этапа (см. record)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+    
+    def render(self, counters: Optional[Dict[str, float]] = None,
+               gauges: Optional[Dict[str, float]] = None) -> str:
+        """Текстовый формат Prometheus; counters и gauges - внешние значения"""
+        lines = []
+        
+        def header(name: str, kind: str, seen: set):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+        
+        with self._lock:
+            own_counters = sorted(self._counters.items())
+            histograms = sorted((key, list(hist)) for key, hist in self._histograms.items())
+        
+        seen = set()
+        for (name, labels), value in own_counters:
+            header(name, "counter", seen)
+            lines.append(f"{self.prefix}_{name}{_format_labels(labels)} {value}")
+        for name, value in sorted((counters or {}).items()):
+            header(name, "counter", seen)
+            lines.append(f"{self.prefix}_{name} {value}")
+        for name, value in sorted((gauges or {}).items()):
+            header(name, "gauge", seen)
+            lines.append(f"{self.prefix}_{name} {value}")
+        
+        for (name, labels), hist in histograms:
+            header(name, "histogram", seen)
+            # observe() увеличивает все подходящие границы - значения уже накопленные
+            for bound, n in zip(self.BUCKETS, hist):
+                lines.append(f"{self.prefix}_{name}_bucket{_format_labels(labels + (('le', bound),))} {n}")
+            lines.append(f"{self.prefix}_{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {hist[-2]}")
+            lines.append(f"{self.prefix}_{name}_count{_format_labels(labels)} {hist[-2]}")
+            lines.append(f"{self.prefix}_{name}_sum{_format_labels(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+class SlowRequestProfiler:
+    """Сэмплирующий профайлер медленных запросов
+    
+    Фоновый поток каждые interval секунд снимает стеки потоков, которые
+    сейчас выполняют запросы (sys._current_frames). Если запрос длился
+    дольше threshold, его свёрнутые стеки передаются в hook; по умолчанию
+    они пишутся в output_dir в формате flamegraph.pl/speedscope.
+    """
+    
+    def __init__(self, threshold: float, interval: float = 0.005, output_dir: Optional[str] = None,
+                 hook: Optional[Callable[[RequestTimings], None]] = None):
+        self.threshold = threshold
+        self.interval = interval
+        self.output_dir = output_dir
+        self.hook = hook or self.write_profile
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name="slow-request-profiler", daemon=True)
+        self._thread.start()
+    
+    def register(self, request: RequestTimings):
+        with self._lock:
+            self._active.add(request)
+    
+    def unregister(self, request: RequestTimings):
+        with self._lock:
+            self._active.discard(request)
+        if request.duration > self.threshold and request.samples:
+            self.hook(request)
+    
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for request in active:
+                for thread_id in list(request.threads):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        request.samples[self._collapse(frame)] += 1
+    
+    @staticmethod
+    def _collapse(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+    
+    def write_profile(self, request: RequestTimings):
+        """Запись свёрнутых стеков медленного запроса в файл"""
+        if self.output_dir is None:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = request.name.strip("/").replace("/", "_") or "root"
+        path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{request.duration:.2f}s.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in request.samples.most_common():
+                f.write(f"{stack} {n}\n")
+        print(f"Медленный запрос {request.name}: {request.duration:.2f} с, профиль {path}")
+
+
+# Общий реестр процесса
+metrics = Metrics()
+# Профайлер медленных запросов (включается enable_profiler)
+profiler: Optional[SlowRequestProfiler] = None
+
+
+def enable_profiler(threshold: float, output_dir: Optional[str] = None,
+                    hook: Optional[Callable[[RequestTimings], None]] = None) -> SlowRequestProfiler:
+    """Включение профилирования запросов дольше threshold секунд"""
+    global profiler
+    if profiler is None:
+        profiler = SlowRequestProfiler(threshold, output_dir=output_dir, hook=hook)
+    return profiler
+
+
+@contextmanager
+def track_request(name: str):
+    """Область запроса: этапы внутри попадают в его RequestTimings"""
+    request = RequestTimings(name)
+    token = _current_request.set(request)
+    if profiler is not None:
+        profiler.register(request)
+    try:
+        yield request
+    finally:
+        request.finished = time.perf_counter()
+        _current_request.reset(token)
+        if profiler is not None:
+            profiler.unregister(request)
+
+
+@contextmanager
+def track_thread():
+    """Отметка, что текущий поток выполняет работу текущего запроса"""
+    request = _current_request.get()
+    if request is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    request.threads.add(thread_id)
+    try:
+        yield
+    finally:
+        request.threads.discard(thread_id)
@@ -0,0 +1,103 @@
+# workers.py
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from metrics import metrics, track_thread
+
+
+class PoolBusyError(Exception):
+    """Очередь пула заполнена"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Сервер занят, повторите через {retry_after} с")
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    """Ограниченный пул потоков для блокирующей CPU/TF работы
+    
+    Одновременно выполняется не более max_workers задач, ещё max_queue
+    ждут в очереди. Сверх этого run() сразу отклоняет задачу с
+    PoolBusyError, чтобы запросы не копились без ограничений.
+    """
+    
+    def __init__(self, max_workers: int = 1, max_queue: int = 8):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+    
+    def retry_after(self) -> int:
+        """Оценка времени до освобождения места в очереди"""
+        avg_run = self.run_total / self.completed if self.completed else 1.0
+        return max(1, math.ceil(avg_run * self._pending / self.max_workers))
+    
+    @property
+    def full(self) -> bool:
+        """Заняты все потоки и вся очередь"""
+        with self._lock:
+            return self._pending >= self.max_workers + self.max_queue
+    
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Выполнение fn в пуле без блокировки event loop"""
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PoolBusyError(self.retry_after())
+            self._pending += 1
+        submitted = time.perf_counter()
+        # Контекст запроса (таймеры metrics) переходит в поток пула
+        context = contextvars.copy_context()
+        
+        def call():
+            started = time.perf_counter()
+            with self._lock:
+                self._running += 1
+                wait = started - submitted
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            metrics.record("queue", wait)
+            try:
+                with track_thread():
+                    return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.run_total += time.perf_counter() - started
+        
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, call)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self.completed += 1
+    
+    def stats(self) -> Dict[str, float]:
+        """Глубина очереди и время ожидания"""
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queue_depth": self._pending - self._running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_avg": self.wait_total / self.completed if self.completed else 0.0,
+                "wait_max": self.wait_max,
+            }
+    
+    def shutdown(self):
+        """Остановка пула"""
+        self._executor.shutdown(wait=False)